@@ -0,0 +1,3 @@
+"""
+Benchmarks for the API, run them from the repository root, e.g. `python -m benchmarks.bench_serializer`
+"""
@@ -0,0 +1,54 @@
+"""
+Compares the gunicorn (WSGI) and uvicorn (ASGI) deployments on the catalog and favorites endpoints
+
+    python -m benchmarks.bench_asgi --scale 10000 --workers 2 --concurrency 64 --duration 10
+"""
+import json
+import argparse
+from benchmarks.env import load_app
+from benchmarks.seed import seed
+from benchmarks.load import free_port, start_server, gunicorn_command, uvicorn_command, run_load
+
+ENDPOINTS = {
+    "catalog list": ["/characters?limit=50&after={n}", "/planets?limit=50", "/starships?limit=50&after={n}"],
+    "catalog item": ["/characters/{n}", "/films/1", "/planets/{n}"],
+    "favorites": ["/favorites?expand=target"],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url")
+    parser.add_argument("--scale", type=int, default=10000)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10)
+    options = parser.parse_args()
+
+    app = load_app(options.database_url)
+    from models import db
+    from flask_jwt_extended import create_access_token
+    with app.app_context():
+        seed(db, options.scale)
+        token = create_access_token(identity="1")
+    database_url = app.config["SQLALCHEMY_DATABASE_URI"]
+    headers = {"Cookie": f"access_token_cookie={token}"}
+
+    # many distinct ids so the response cache does not turn this into a pure cache benchmark
+    paths = {name: [template.format(n=n) for n in range(1, 2000, 7) for template in templates]
+             for name, templates in ENDPOINTS.items()}
+    report = {"scale": options.scale, "workers": options.workers, "concurrency": options.concurrency, "results": {}}
+    for mode, command in (("wsgi", gunicorn_command), ("asgi", uvicorn_command)):
+        port = free_port()
+        server = start_server(command(port, options.workers), database_url, port, env={"CACHE_MAX_ENTRIES": "0"})
+        try:
+            report["results"][mode] = {name: run_load(port, endpoint_paths, options.concurrency, options.duration, headers)
+                                       for name, endpoint_paths in paths.items()}
+        finally:
+            server.terminate()
+            server.wait()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
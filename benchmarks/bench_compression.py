@@ -0,0 +1,89 @@
+"""
+CPU time against bytes on the wire for each codec and level on the response bodies of the existing endpoints,
+and what reusing the compressed variants of catalog responses saves per request
+
+    python -m benchmarks.bench_compression --scale 10000
+"""
+import json
+import time
+import argparse
+import statistics
+from benchmarks.env import load_app
+from benchmarks.seed import seed
+from benchmarks.suite import ENDPOINTS, endpoint_paths
+
+LEVELS = {"gzip": (1, 6, 9), "br": (1, 5, 11), "zstd": (1, 3, 9, 19)}
+
+
+def codec_costs(codecs, bodies, repeat):
+    raw = sum(len(body) for body in bodies)
+    results = {"raw_bytes": raw}
+    for name, levels in LEVELS.items():
+        if name not in codecs:
+            continue
+        for level in levels:
+            timings, size = [], 0
+            for body in bodies:
+                started = time.perf_counter()
+                for _ in range(repeat):
+                    compressed = codecs[name](body, level)
+                timings.append((time.perf_counter() - started) / repeat)
+                size += len(compressed)
+            results[f"{name}-{level}"] = {"bytes": size, "ratio": round(raw / size, 2),
+                                          "us_per_body": round(statistics.median(timings) * 1e6, 1),
+                                          "mb_per_s": round(raw / sum(timings) / 2**20, 1)}
+    return results
+
+
+def request_rate(client, paths, encoding, requests):
+    headers = {"Accept-Encoding": encoding} if encoding else {}
+    for path in paths:
+        client.get(path, headers=headers)
+    wire = 0
+    started = time.perf_counter()
+    for i in range(requests):
+        wire += len(client.get(paths[i % len(paths)], headers=headers).get_data())
+    elapsed = time.perf_counter() - started
+    return {"rps": round(requests / elapsed, 1), "bytes_per_response": wire // requests}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url")
+    parser.add_argument("--scale", type=int, default=10000)
+    parser.add_argument("--samples", type=int, default=20, help="response bodies per endpoint")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=500)
+    options = parser.parse_args()
+
+    app = load_app(options.database_url)
+    from models import db
+    from compression import CODECS, compressor, compressed_variants
+    from flask_jwt_extended import create_access_token
+    with app.app_context():
+        counts = seed(db, options.scale)
+        token = create_access_token(identity="1")
+    counts.update({"characters": counts["people"], "user": counts["users"]})
+    client = app.test_client()
+    client.set_cookie("access_token_cookie", token)
+
+    report = {"codecs": sorted(CODECS), "endpoints": {}, "requests": {}}
+    for name, template in ENDPOINTS.items():
+        paths = endpoint_paths(template, counts, options.samples)
+        bodies = [client.get(path).get_data() for path in paths]
+        report["endpoints"][name] = codec_costs(CODECS, bodies, options.repeat)
+
+    # catalog list pages through the full stack: uncompressed, compressed on every request, compressed once per version
+    paths = endpoint_paths(ENDPOINTS["characters list"], counts, 50)
+    report["requests"]["identity"] = request_rate(client, paths, None, options.requests)
+    for encoding in compressor.encodings:
+        compressed_variants.max_entries = 0
+        every = request_rate(client, paths, encoding, options.requests)
+        compressed_variants.max_entries = 1024
+        reused = request_rate(client, paths, encoding, options.requests)
+        report["requests"][encoding] = {"every_request": every, "precompressed": reused}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Open /events streams against gunicorn (a thread per stream) and uvicorn (a coroutine per stream): how many
+are accepted, whether the other routes still answer while they are open, and how long a commit takes to
+reach every stream
+
+    python -m benchmarks.bench_events --streams 64 --concurrency 8 --duration 5
+
+Exits 1 when a route answered by the Flask app fails while the streams are open.
+"""
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import http.client
+from benchmarks.env import load_app, SRC
+from benchmarks.seed import seed
+from benchmarks.load import free_port, start_server, gunicorn_command, uvicorn_command, run_load, latency_summary
+
+# /user is served by Flask in both modes, through the WSGI fallback under uvicorn
+ROUTES = {"fallback": ["/user"], "catalog": ["/characters?limit=20", "/planets?limit=20"]}
+
+
+class Stream:
+    def __init__(self, port, headers):
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        self.connection.request("GET", "/events", headers=headers)
+        self.response = self.connection.getresponse()
+        self.status = self.response.status
+        self.retry_after = self.response.getheader("Retry-After")
+        self.received = {}
+        if self.status == 200:
+            # the retry line is sent first, once it is here the stream is subscribed
+            self.response.readline()
+            threading.Thread(target=self.read, daemon=True).start()
+        else:
+            self.response.read()
+
+    def read(self):
+        try:
+            for line in self.response:
+                if line.startswith(b"data: ") and b'"external_id"' in line:
+                    self.received[json.loads(line[6:])["favorite"]["external_id"]] = time.perf_counter()
+        except (OSError, ValueError, AttributeError, http.client.HTTPException):
+            pass
+
+    def close(self):
+        # close() alone leaves the socket open under the reader thread blocked on it
+        if self.connection.sock is not None:
+            self.connection.sock.shutdown(socket.SHUT_RDWR)
+        self.connection.close()
+
+
+def delivery(port, headers, streams, external_ids):
+    # each round adds a favorite nobody has, every open stream of the same user gets its event
+    latencies = []
+    lost = 0
+    for external_id in external_ids:
+        body = json.dumps({"name": f"Bench {external_id}", "type": "Planets", "external_id": external_id})
+        # a connection per round, waiting for a lost event outlasts gunicorn's keep-alive
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        started = time.perf_counter()
+        connection.request("POST", "/favorites", body, {**headers, "Content-Type": "application/json"})
+        connection.getresponse().read()
+        connection.close()
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and any(external_id not in stream.received for stream in streams):
+            time.sleep(0.001)
+        arrived = [stream.received[external_id] for stream in streams if external_id in stream.received]
+        lost += len(streams) - len(arrived)
+        latencies += [stamp - started for stamp in arrived]
+    return {"events": len(latencies), "lost": lost, **latency_summary(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url")
+    parser.add_argument("--scale", type=int, default=1000)
+    parser.add_argument("--streams", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=8, help="GUNICORN_THREADS of the one gunicorn worker")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--rounds", type=int, default=20)
+    options = parser.parse_args()
+
+    app = load_app(options.database_url)
+    from models import db
+    from flask_jwt_extended import create_access_token, get_csrf_token
+    with app.app_context():
+        seed(db, options.scale)
+        token = create_access_token(identity="1")
+        csrf_token = get_csrf_token(token)
+    database_url = app.config["SQLALCHEMY_DATABASE_URI"]
+    headers = {"Cookie": f"access_token_cookie={token}", "X-CSRF-TOKEN": csrf_token}
+
+    modes = {
+        "wsgi": lambda port: gunicorn_command(port, 1, ["-c", f"{SRC}/gunicorn.conf.py"]),
+        "asgi": lambda port: uvicorn_command(port, 1),
+    }
+    report = {"streams": options.streams, "threads": options.threads, "results": {}}
+    failed = False
+    for offset, (mode, command) in enumerate(modes.items()):
+        port = free_port()
+        server = start_server(command(port), database_url, port, env={
+            "GUNICORN_THREADS": str(options.threads), "SHARED_CACHE_PATH": ""})
+        streams = []
+        try:
+            streams = [Stream(port, headers) for _ in range(options.streams)]
+            accepted = [stream for stream in streams if stream.status == 200]
+            rejected = [stream for stream in streams if stream.status != 200]
+            result = {
+                "accepted": len(accepted),
+                "rejected": len(rejected),
+                "rejected_with_retry_after": sum(stream.retry_after is not None for stream in rejected),
+                **{name: run_load(port, paths, options.concurrency, options.duration, headers)
+                   for name, paths in ROUTES.items()},
+                # the modes share the database, each adds favorites of its own
+                "delivery": delivery(port, headers, accepted, range(900000 + offset * options.rounds,
+                                                                    900000 + (offset + 1) * options.rounds)),
+            }
+            failed |= mode == "asgi" and (result["fallback"]["errors"] > 0 or not result["fallback"]["requests"])
+            report["results"][mode] = result
+        finally:
+            for stream in streams:
+                stream.close()
+            server.terminate()
+            server.wait()
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
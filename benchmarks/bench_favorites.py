@@ -0,0 +1,76 @@
+"""
+Favorites lookup latency per user with and without the (user_id, type, external_id) index
+
+    python -m benchmarks.bench_favorites --users 100000 --favorites 1000000
+"""
+import json
+import time
+import random
+import argparse
+from sqlalchemy import MetaData, Table, Column
+from benchmarks.env import load_app
+from benchmarks.seed import insert, batched
+from benchmarks.load import percentile
+
+
+def lookup_latency(db, table, users, lookups, rng):
+    timings = []
+    query = table.select().where(table.c.user_id == db.bindparam("user_id"))
+    with db.engine.connect() as connection:
+        for _ in range(lookups):
+            started = time.perf_counter()
+            connection.execute(query, {"user_id": rng.randint(1, users)}).all()
+            timings.append(time.perf_counter() - started)
+    return {"p50_ms": round(percentile(timings, 0.5) * 1000, 3), "p99_ms": round(percentile(timings, 0.99) * 1000, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--favorites", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=200)
+    options = parser.parse_args()
+
+    app = load_app(options.database_url)
+    from models import db, Favorites
+    rng = random.Random(3)
+    types = ["People", "Planets", "Films", "Starships"]
+
+    # the same table as before the migration: no unique constraint, nothing on user_id
+    before = Table("Favorites_before", MetaData(),
+                   *(Column(column.name, column.type, primary_key=column.primary_key) for column in Favorites.__table__.columns))
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        before.drop(db.engine, checkfirst=True)
+        before.create(db.engine)
+        from models import User
+        insert(db, User, ({"username": f"user{i}", "first_name": "a", "last_name": "b", "email": f"user{i}@example.com",
+                           "password": "x", "is_active": True} for i in range(1, options.users + 1)))
+
+        seen = set()
+        rows = []
+        while len(rows) < options.favorites:
+            row = (rng.randint(1, options.users), rng.choice(types), rng.randint(1, 10000))
+            if row not in seen:
+                seen.add(row)
+                rows.append({"user_id": row[0], "type": row[1], "external_id": row[2], "name": "favorite"})
+        for batch in batched(rows, 20000):
+            db.session.execute(before.insert(), batch)
+            db.session.execute(db.insert(Favorites), batch)
+        db.session.commit()
+
+        report = {
+            "users": options.users,
+            "favorites": options.favorites,
+            "before (no index)": lookup_latency(db, before, options.users, options.lookups, rng),
+            "after (unique user_id, type, external_id)": lookup_latency(db, Favorites.__table__, options.users, options.lookups, rng),
+        }
+        before.drop(db.engine)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
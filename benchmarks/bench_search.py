@@ -0,0 +1,62 @@
+"""
+Latency of the in-process /search index, including typos, over a seeded catalog
+
+    python -m benchmarks.bench_search --scale 100000
+"""
+import json
+import time
+import random
+import argparse
+import tracemalloc
+from benchmarks.env import load_app
+from benchmarks.seed import seed
+from benchmarks.load import percentile
+
+QUERIES = ["Person {n}", "Persn {n}", "Planet {n}", "Plnaet {n}", "Starship {n}", "tundra", "Yard 7", "Director 3", "arid", "Episode {n}"]
+# ?type= searches, the other tables' postings are not read
+TYPED_QUERIES = [("Planet {n}", {"Planets"}), ("arid", {"Planets"}), ("Persn {n}", {"People"}), ("Yard 7", {"Starships"})]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url")
+    parser.add_argument("--scale", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=2000)
+    options = parser.parse_args()
+
+    app = load_app(options.database_url)
+    from models import db
+    from search import search_index
+    rng = random.Random(7)
+    with app.app_context():
+        counts = seed(db, options.scale, favorites_per_user=0)
+        tracemalloc.start()
+        search_index.build()
+        index_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        timings, typed_timings = [], []
+        for _ in range(options.queries):
+            query = rng.choice(QUERIES).format(n=rng.randint(1, options.scale // 10))
+            started = time.perf_counter()
+            search_index.search(query, limit=20)
+            timings.append(time.perf_counter() - started)
+            query, tables = rng.choice(TYPED_QUERIES)
+            started = time.perf_counter()
+            search_index.search(query.format(n=rng.randint(1, options.scale // 10)), tables, limit=20)
+            typed_timings.append(time.perf_counter() - started)
+
+    entities = sum(value for key, value in counts.items() if key in ("people", "planets", "films", "starships"))
+    print(json.dumps({
+        "entities": entities,
+        "build_s": round(search_index.build_seconds, 2),
+        "index_mib": round(index_bytes / 2**20, 1),
+        "p50_ms": round(percentile(timings, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 3),
+        "typed_p50_ms": round(percentile(typed_timings, 0.5) * 1000, 3),
+        "typed_p99_ms": round(percentile(typed_timings, 0.99) * 1000, 3),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Compares the dataclass + stdlib jsonify path with the precompiled serializer on a large People table
+
+    python -m benchmarks.bench_serializer --rows 100000
+"""
+import gc
+import json
+import time
+import argparse
+import tracemalloc
+from benchmarks.env import load_app
+
+
+def seed_people(db, People, rows):
+    db.drop_all()
+    db.create_all()
+    db.session.execute(db.insert(People), [
+        {
+            "name": f"Person {i}", "skin_color": "fair", "hair_color": "blond", "eye_color": "blue",
+            "birth_year": f"{i % 100}BBY", "gender": "male" if i % 2 else "female", "url": f"https://swapi.dev/api/people/{i}/",
+            "height": 150 + i % 60, "mass": 50 + i % 70, "homeworld": None,
+        }
+        for i in range(rows)
+    ])
+    db.session.commit()
+
+
+def measure(label, fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        size = fn()
+        timings.append(time.perf_counter() - started)
+
+    # tracemalloc slows everything down, so memory gets its own run
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"path": label, "best_s": round(min(timings), 4), "peak_mib": round(peak / 2**20, 1), "bytes": size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    options = parser.parse_args()
+
+    app = load_app()
+    from flask.json.provider import DefaultJSONProvider
+    from models import db, People
+    import serializer
+
+    default_provider = DefaultJSONProvider(app)
+    with app.app_context():
+        seed_people(db, People, options.rows)
+
+        def dataclass_jsonify():
+            # what the endpoints did before: every ORM object, dataclasses.asdict and the stdlib encoder
+            db.session.expunge_all()
+            return len(default_provider.response(People.query.all()).get_data())
+
+        def fast_jsonify():
+            db.session.expunge_all()
+            return len(app.json.response(People.query.all()).get_data())
+
+        def fast_stream():
+            db.session.expunge_all()
+            rows = db.session.execute(db.select(People).execution_options(yield_per=1000)).scalars()
+            return sum(len(chunk) for chunk in serializer.stream_list(rows))
+
+        results = [
+            measure("dataclass + stdlib jsonify", dataclass_jsonify, options.repeat),
+            measure(f"precompiled encoder ({'orjson' if serializer.orjson else 'stdlib'})", fast_jsonify, options.repeat),
+            measure("precompiled encoder, streamed", fast_stream, options.repeat),
+        ]
+    print(json.dumps({"rows": options.rows, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Response cache hit rate and worker memory under gunicorn, one cache per worker against the shared memory cache
+
+    python -m benchmarks.bench_shared_cache --workers 4 --paths 2000 --duration 10
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import statistics
+from benchmarks.env import load_app, SRC
+from benchmarks.seed import seed
+from benchmarks.load import free_port, start_server, gunicorn_command, run_load
+from benchmarks.bench_startup import memory_mb, worker_pids
+
+
+def catalog_paths(counts, total):
+    # list pages over every catalog table, `total` distinct keys that each worker would otherwise cache on its own
+    templates = [("/characters?limit=50&after={n}", counts["people"]), ("/planets?limit=50&after={n}", counts["planets"]),
+                 ("/starships?limit=50&after={n}", counts["starships"]), ("/characters/{n}", counts["people"])]
+    per_template = total // len(templates)
+    return [template.format(n=1 + i * max(upper // per_template, 1) % upper)
+            for template, upper in templates for i in range(per_template)]
+
+
+def run(database_url, paths, options, env):
+    port = free_port()
+    server = start_server(gunicorn_command(port, options.workers, ["-c", os.path.join(SRC, "gunicorn.conf.py"), "--preload"]),
+                          database_url, port, env=env)
+    try:
+        started = time.perf_counter()
+        cold = run_load(port, paths, options.concurrency, options.duration)
+        warm = run_load(port, paths, options.concurrency, options.duration)
+        per_worker = [memory_mb(pid) for pid in worker_pids(server.pid)]
+        return {
+            "cold": {key: cold.get(key) for key in ("requests", "rps", "p50_ms", "p99_ms", "cache_hit_rate")},
+            "warm": {key: warm.get(key) for key in ("requests", "rps", "p50_ms", "p99_ms", "cache_hit_rate")},
+            "seconds": round(time.perf_counter() - started, 1),
+            "worker_avg_mb": {key: round(statistics.mean(worker[key] for worker in per_worker), 1) for key in per_worker[0]},
+            "total_pss_mb": round(memory_mb(server.pid)["pss"] + sum(worker["pss"] for worker in per_worker), 1),
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url")
+    parser.add_argument("--scale", type=int, default=10000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="seconds of the cold and of the warm run")
+    parser.add_argument("--paths", type=int, default=2000, help="distinct cache keys")
+    parser.add_argument("--slots", type=int, default=4096)
+    options = parser.parse_args()
+
+    app = load_app(options.database_url)
+    from models import db
+    with app.app_context():
+        counts = seed(db, options.scale)
+    database_url = app.config["SQLALCHEMY_DATABASE_URI"]
+    paths = catalog_paths(counts, options.paths)
+
+    shared_path = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), f"bench-cache-{os.getpid()}")
+    report = {"workers": options.workers, "paths": len(paths), "results": {}}
+    report["results"]["per-process"] = run(database_url, paths, options, {"CACHE_MAX_ENTRIES": str(options.paths),
+                                                                        "SHARED_CACHE_PATH": ""})
+    try:
+        report["results"]["shared"] = run(database_url, paths, options, {
+            "SHARED_CACHE_PATH": shared_path, "SHARED_CACHE_SLOTS": str(options.slots)})
+    finally:
+        if os.path.exists(shared_path):
+            os.remove(shared_path)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
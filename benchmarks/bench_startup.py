@@ -0,0 +1,109 @@
+"""
+Cold start time and per-worker memory of the app factory, with the admin lazy or eager and with or without --preload
+
+    python -m benchmarks.bench_startup --workers 4 --runs 5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.env import load_app, SRC
+from benchmarks.seed import seed
+from benchmarks.load import free_port, start_server, gunicorn_command
+
+IMPORT_SNIPPET = """
+import time, resource
+started = time.perf_counter()
+from app import create_app
+create_app()
+print(time.perf_counter() - started, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def create_app_cost(admin_mode, runs):
+    seconds, rss = [], []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=SRC, capture_output=True, text=True,
+                                env=dict(os.environ, ADMIN_MODE=admin_mode), check=True).stdout.split()
+        seconds.append(float(output[0]))
+        rss.append(int(output[1]) / 1024)
+    return {"create_app_ms": round(statistics.median(seconds) * 1000, 1), "max_rss_mb": round(statistics.median(rss), 1)}
+
+
+def memory_mb(pid):
+    # Pss splits shared pages between the processes mapping them, Private is what a worker costs on its own
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as handle:
+        for line in handle:
+            parts = line.split()
+            if parts[0] in ("Rss:", "Pss:", "Private_Clean:", "Private_Dirty:"):
+                values[parts[0][:-1]] = int(parts[1]) / 1024
+    return {"rss": round(values["Rss"], 1), "pss": round(values["Pss"], 1),
+            "private": round(values["Private_Clean"] + values["Private_Dirty"], 1)}
+
+
+def worker_pids(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as handle:
+        return [int(child) for child in handle.read().split()]
+
+
+def get(port, path):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    connection.request("GET", path)
+    connection.getresponse().read()
+    connection.close()
+
+
+def gunicorn_cost(database_url, workers, preload, admin_mode):
+    port = free_port()
+    extra = ["-c", os.path.join(SRC, "gunicorn.conf.py")] + (["--preload"] if preload else [])
+    started = time.perf_counter()
+    server = start_server(gunicorn_command(port, workers, extra), database_url, port, env={"ADMIN_MODE": admin_mode})
+    try:
+        get(port, "/films/1")
+        ready = time.perf_counter() - started
+        # concurrent requests reach every sync worker, so each one has loaded the app and served traffic
+        with ThreadPoolExecutor(workers * 2) as pool:
+            list(pool.map(lambda n: get(port, f"/characters?limit=50&after={n}"), range(workers * 50)))
+        per_worker = [memory_mb(pid) for pid in worker_pids(server.pid)]
+        return {
+            "first_response_ms": round(ready * 1000, 1),
+            "master": memory_mb(server.pid),
+            "worker_avg": {key: round(statistics.mean(worker[key] for worker in per_worker), 1) for key in per_worker[0]},
+            "total_pss_mb": round(memory_mb(server.pid)["pss"] + sum(worker["pss"] for worker in per_worker), 1),
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url")
+    parser.add_argument("--scale", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=5)
+    options = parser.parse_args()
+
+    app = load_app(options.database_url)
+    from models import db
+    with app.app_context():
+        seed(db, options.scale)
+    database_url = app.config["SQLALCHEMY_DATABASE_URI"]
+
+    report = {"create_app": {mode: create_app_cost(mode, options.runs) for mode in ("lazy", "eager", "off")},
+              "gunicorn": {}, "workers": options.workers}
+    for preload in (False, True):
+        for admin_mode in ("lazy", "eager"):
+            name = f"{'preload' if preload else 'no preload'}, admin {admin_mode}"
+            report["gunicorn"][name] = gunicorn_cost(database_url, options.workers, preload, admin_mode)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
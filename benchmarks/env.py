@@ -0,0 +1,19 @@
+"""
+Imports the app from ./src against a throwaway database
+"""
+import os
+import sys
+import tempfile
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+
+def load_app(database_url=None):
+    # create_app() reads DATABASE_URL from the environment
+    if database_url is None:
+        database_url = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db")
+    os.environ["DATABASE_URL"] = database_url
+    if SRC not in sys.path:
+        sys.path.insert(0, SRC)
+    from app import create_app
+    return create_app()
@@ -0,0 +1,137 @@
+"""
+Starts an API server process and drives it with concurrent keep-alive HTTP clients
+"""
+import os
+import sys
+import time
+import socket
+import threading
+import subprocess
+import http.client
+from benchmarks.env import SRC
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(command, database_url, port, env=None, timeout=30):
+    environment = dict(os.environ, DATABASE_URL=database_url, PYTHONPATH=SRC, **(env or {}))
+    process = subprocess.Popen(command, env=environment, cwd=os.path.dirname(SRC),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{command[0]} exited with {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{command[0]} did not start listening on {port}")
+
+
+def gunicorn_command(port, workers, extra=()):
+    return [sys.executable, "-m", "gunicorn", "wsgi", "--chdir", SRC, "-w", str(workers), "-b", f"127.0.0.1:{port}", *extra]
+
+
+def uvicorn_command(port, workers, extra=()):
+    return [sys.executable, "-m", "uvicorn", "asgi:application", "--app-dir", SRC, "--workers", str(workers),
+            "--port", str(port), "--log-level", "warning", *extra]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run_load(port, paths, concurrency, duration, headers=None):
+    """Each client thread cycles through paths on its own connection for `duration` seconds"""
+    latencies = []
+    errors = [0]
+    cache = {}
+    lock = threading.Lock()
+    stop = time.monotonic() + duration
+
+    def client(offset):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        local = []
+        local_cache = {}
+        failed = 0
+        i = offset
+        while time.monotonic() < stop:
+            path = paths[i % len(paths)]
+            i += 1
+            started = time.perf_counter()
+            try:
+                connection.request("GET", path, headers=headers or {})
+                response = connection.getresponse()
+                response.read()
+                outcome = response.getheader("X-Cache")
+                if outcome:
+                    local_cache[outcome] = local_cache.get(outcome, 0) + 1
+                if response.status >= 400:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                continue
+            local.append(time.perf_counter() - started)
+        connection.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+            for outcome, count in local_cache.items():
+                cache[outcome] = cache.get(outcome, 0) + count
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    result = {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "rps": round(len(latencies) / elapsed, 1),
+        **latency_summary(latencies),
+    }
+    if cache:
+        # X-Cache of the responses that went through the response cache
+        result["cache_hit_rate"] = round(cache.get("HIT", 0) / sum(cache.values()), 3)
+    return result
+
+
+def latency_summary(latencies):
+    # latencies in seconds, reported in milliseconds
+    return {f"p{int(fraction * 100)}_ms": round(percentile(latencies, fraction) * 1000, 2) if latencies else None
+            for fraction in (0.50, 0.90, 0.95, 0.99)}
+
+
+def process_rss_mb(pid):
+    # resident memory of the process and all its children (the gunicorn workers), Linux only
+    def children(parent):
+        try:
+            with open(f"/proc/{parent}/task/{parent}/children") as handle:
+                return [int(child) for child in handle.read().split()]
+        except OSError:
+            return []
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/statm") as handle:
+                total += int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            continue
+        pending.extend(children(current))
+    return round(total / 2**20, 1) if total else None
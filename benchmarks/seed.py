@@ -0,0 +1,101 @@
+"""
+Synthetic catalog, users and favorites for the benchmarks
+
+    python -m benchmarks.seed --database-url sqlite:////tmp/bench.db --scale 10000
+"""
+import json
+import random
+import argparse
+from itertools import islice
+from benchmarks.env import load_app
+
+BATCH_SIZE = 5000
+CLIMATES = ["arid", "temperate", "frozen", "murky", "tropical", "windy"]
+TERRAINS = ["desert", "grasslands", "tundra", "swamp", "jungle", "ocean"]
+CLASSES = ["Starfighter", "Corvette", "Star Destroyer", "Transport", "Freighter"]
+
+
+def batched(rows, size=BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def insert(db, model, rows):
+    for batch in batched(rows):
+        db.session.execute(db.insert(model), batch)
+    db.session.commit()
+
+
+def seed(db, scale, users=None, favorites_per_user=10, random_seed=42):
+    """Fills every table, `scale` People, scale/10 Planets and Starships, scale/100 Films and scale/10 Users"""
+    from models import People, Planets, Films, Starships, User, Favorites
+    rng = random.Random(random_seed)
+    planets = max(scale // 10, 1)
+    starships = max(scale // 10, 1)
+    films = max(scale // 100, 1)
+    users = users if users is not None else max(scale // 10, 1)
+
+    db.drop_all()
+    db.create_all()
+    insert(db, Planets, ({
+        "name": f"Planet {i}", "population": rng.randint(0, 10**9), "climate": rng.choice(CLIMATES),
+        "diameter": rng.randint(1000, 200000), "rotation_period": rng.randint(10, 40), "orbital_period": rng.randint(100, 800),
+        "gravity": "1 standard", "terrain": rng.choice(TERRAINS), "url": f"https://swapi.dev/api/planets/{i}/",
+    } for i in range(1, planets + 1)))
+    insert(db, People, ({
+        "name": f"Person {i}", "skin_color": "fair", "hair_color": rng.choice(["blond", "brown", "black", "none"]),
+        "eye_color": rng.choice(["blue", "brown", "yellow"]), "birth_year": f"{rng.randint(1, 900)}BBY",
+        "gender": rng.choice(["male", "female", "n/a"]), "url": f"https://swapi.dev/api/people/{i}/",
+        "height": rng.randint(60, 260), "mass": rng.randint(20, 1400), "homeworld": f"Planet {rng.randint(1, planets)}",
+    } for i in range(1, scale + 1)))
+    insert(db, Films, ({
+        "title": f"Episode {i}", "episode_id": i, "release_date": f"{1977 + i % 50}-05-25", "director": f"Director {i % 7}",
+        "producer": "Producer", "opening_crawl": "It is a period of civil war.", "url": f"https://swapi.dev/api/films/{i}/",
+    } for i in range(1, films + 1)))
+    insert(db, Starships, ({
+        "name": f"Starship {i}", "model": f"Model {i % 97}", "starship_class": rng.choice(CLASSES), "manufacturer": f"Yard {i % 13}",
+        "cost_in_credits": str(rng.randint(10**4, 10**9)), "length": rng.randint(5, 20000), "crew": str(rng.randint(1, 50000)),
+        "max_atmosphering_speed": str(rng.randint(100, 1500)), "hyperdrive_rating": f"{rng.choice([0.5, 1, 2, 4])}",
+        "MGLT": str(rng.randint(10, 150)), "cargo_capacity": str(rng.randint(0, 10**8)), "consumables": "1 month",
+        "url": f"https://swapi.dev/api/starships/{i}/",
+    } for i in range(1, starships + 1)))
+    # the password is a placeholder, benchmarks authenticate with tokens they mint themselves
+    insert(db, User, ({
+        "username": f"user{i}", "first_name": "Bench", "last_name": f"User {i}", "email": f"user{i}@example.com",
+        "password": "x", "is_active": True,
+    } for i in range(1, users + 1)))
+    targets = [("People", scale), ("Planets", planets), ("Films", films), ("Starships", starships)]
+
+    def favorites():
+        for user_id in range(1, users + 1):
+            # (user_id, type, external_id) is unique
+            chosen = set()
+            while len(chosen) < min(favorites_per_user, scale):
+                favorite_type, count = rng.choice(targets)
+                chosen.add((favorite_type, rng.randint(1, count)))
+            for favorite_type, external_id in chosen:
+                yield {"user_id": user_id, "external_id": external_id, "name": "favorite", "type": favorite_type}
+    insert(db, Favorites, favorites())
+    return {"people": scale, "planets": planets, "films": films, "starships": starships,
+            "users": users, "favorites": users * min(favorites_per_user, scale)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url")
+    parser.add_argument("--scale", type=int, default=10000)
+    parser.add_argument("--favorites-per-user", type=int, default=10)
+    options = parser.parse_args()
+
+    app = load_app(options.database_url)
+    from models import db
+    with app.app_context():
+        print(json.dumps(seed(db, options.scale, favorites_per_user=options.favorites_per_user)))
+
+
+if __name__ == "__main__":
+    main()
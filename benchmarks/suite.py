@@ -0,0 +1,191 @@
+"""
+End-to-end benchmark of the API routes, in-process through the Flask test client and over HTTP against gunicorn
+
+    python -m benchmarks.suite --scale 10000 --output results.json
+    python -m benchmarks.suite --scale 10000 --compare results.json   # exits 1 on a regression
+
+The report has throughput, latency percentiles and memory per endpoint and mode, with the commit it ran on.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import subprocess
+from datetime import datetime, timezone
+from benchmarks.env import load_app
+from benchmarks.seed import seed
+from benchmarks.load import free_port, start_server, gunicorn_command, run_load, latency_summary, process_rss_mb
+
+# {n} is replaced by ids spread over the seeded rows, so most requests miss the response cache
+ENDPOINTS = {
+    "characters list": "/characters?limit=50&after={n}",
+    "characters filtered": "/characters?gender=female&limit=20&after={n}",
+    "characters expand": "/characters?limit=20&after={n}&expand=homeworld",
+    "character": "/characters/{n}",
+    "planets list": "/planets?limit=50&after={n}",
+    "starships list": "/starships?limit=50&after={n}",
+    "film": "/films/{n}",
+    "search": "/search?q=Person%20{n}",
+    "favorites": "/favorites",
+    "favorites expand": "/favorites?expand=target",
+    "user": "/user/{n}",
+}
+
+
+def endpoint_paths(template, counts, samples=200):
+    if "{n}" not in template:
+        return [template]
+    resource = template.split("?")[0].strip("/").split("/")[0]
+    upper = counts.get(resource, counts["people"])
+    step = max(upper // samples, 1)
+    return [template.format(n=n) for n in range(1, upper + 1, step)][:samples]
+
+
+def commit_id():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as handle:
+            return round(int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+    except OSError:
+        return None
+
+
+def bench_test_client(client, paths, requests):
+    for path in paths[:5]:
+        client.get(path)
+
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for i in range(requests):
+        request_started = time.perf_counter()
+        response = client.get(paths[i % len(paths)])
+        response.get_data()
+        latencies.append(time.perf_counter() - request_started)
+        errors += response.status_code >= 400
+    elapsed = time.perf_counter() - started
+
+    # allocations are measured in a separate, shorter pass, tracemalloc slows every request down
+    tracemalloc.start()
+    for path in paths[:50]:
+        client.get(path).get_data()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"requests": requests, "errors": errors, "rps": round(requests / elapsed, 1), **latency_summary(latencies),
+            "peak_alloc_kb": round(peak / 1024, 1), "rss_mb": current_rss_mb()}
+
+
+def bench_gunicorn(database_url, paths, options, headers):
+    port = free_port()
+    server = start_server(gunicorn_command(port, options.workers, ["--threads", str(options.threads)]),
+                          database_url, port, env={"CACHE_MAX_ENTRIES": str(options.cache_entries)})
+    try:
+        # the workers import the app after the port is open, the first requests would pay for that
+        run_load(port, [path for endpoint in paths.values() for path in endpoint[:5]], options.concurrency, 2, headers)
+        results = {}
+        for name, endpoint in paths.items():
+            results[name] = run_load(port, endpoint, options.concurrency, options.duration, headers)
+            results[name]["rss_mb"] = process_rss_mb(server.pid)
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def regressions(baseline, report, threshold):
+    found = []
+    for mode, results in report["results"].items():
+        for name, result in results.items():
+            before = baseline.get("results", {}).get(mode, {}).get(name)
+            if not before:
+                continue
+            if before.get("rps") and result["rps"] < before["rps"] * (1 - threshold):
+                found.append(f"{mode} {name}: {before['rps']} -> {result['rps']} req/s")
+            for key in ("p50_ms", "p99_ms"):
+                if before.get(key) and result.get(key) and result[key] > before[key] * (1 + threshold):
+                    found.append(f"{mode} {name}: {key} {before[key]} -> {result[key]}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="defaults to a fresh SQLite file")
+    parser.add_argument("--scale", type=int, default=10000, help="number of People, the other tables scale from it")
+    parser.add_argument("--modes", default="test-client,gunicorn")
+    parser.add_argument("--endpoints", help="comma separated names, defaults to all")
+    parser.add_argument("--requests", type=int, default=500, help="per endpoint in test-client mode")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5, help="seconds per endpoint in gunicorn mode")
+    parser.add_argument("--cache-entries", type=int, default=0, help="response cache size, 0 disables it")
+    parser.add_argument("--output")
+    parser.add_argument("--compare", help="a previous report, exits 1 when an endpoint got slower")
+    parser.add_argument("--threshold", type=float, default=0.15)
+    options = parser.parse_args()
+
+    app = load_app(options.database_url)
+    from models import db
+    from cache import response_cache
+    from flask_jwt_extended import create_access_token
+    with app.app_context():
+        seeded_started = time.perf_counter()
+        counts = seed(db, options.scale)
+        seed_seconds = time.perf_counter() - seeded_started
+        token = create_access_token(identity="1")
+    headers = {"Cookie": f"access_token_cookie={token}"}
+    counts.update({"characters": counts["people"], "user": counts["users"]})
+
+    names = options.endpoints.split(",") if options.endpoints else list(ENDPOINTS)
+    unknown = [name for name in names if name not in ENDPOINTS]
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(unknown)}")
+    paths = {name: endpoint_paths(ENDPOINTS[name], counts) for name in names}
+
+    report = {
+        "commit": commit_id(),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "database": app.config["SQLALCHEMY_DATABASE_URI"].split(":")[0],
+        "seeded": counts,
+        "seed_seconds": round(seed_seconds, 1),
+        "options": {key: value for key, value in vars(options).items() if key not in ("output", "compare", "database_url")},
+        "results": {},
+    }
+    modes = options.modes.split(",")
+    if "test-client" in modes:
+        response_cache.max_entries = options.cache_entries
+        response_cache.enabled = options.cache_entries > 0
+        # the test client keeps its own cookie jar and ignores a Cookie header
+        client = app.test_client()
+        client.set_cookie("access_token_cookie", token)
+        report["results"]["test-client"] = {name: bench_test_client(client, endpoint, options.requests)
+                                            for name, endpoint in paths.items()}
+    if "gunicorn" in modes:
+        report["results"]["gunicorn"] = bench_gunicorn(app.config["SQLALCHEMY_DATABASE_URI"], paths, options, headers)
+
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as handle:
+            handle.write(output + "\n")
+    print(output)
+
+    if options.compare:
+        with open(options.compare) as handle:
+            found = regressions(json.load(handle), report, options.threshold)
+        for line in found:
+            print(f"regression: {line}", file=sys.stderr)
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""numeric shadow columns for Starships and People
+
+Revision ID: d7a1c3e9f520
+Revises: c5e2f4a81d37
+Create Date: 2026-10-18 15:02:44.118306
+
+"""
+import re
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7a1c3e9f520'
+down_revision = 'c5e2f4a81d37'
+branch_labels = None
+depends_on = None
+
+# frozen copies of swapi.parse_quantity / parse_birth_year as of this revision, later
+# changes to the app's parsers must not change what this migration backfills
+UNKNOWN = {'', 'unknown', 'n/a', 'none', 'indefinite'}
+
+
+def parse_number(value, cast=int):
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return cast(value)
+    text = str(value).strip().lower().replace(',', '')
+    if text in UNKNOWN:
+        return None
+    try:
+        return cast(float(text)) if cast is int else cast(text)
+    except (ValueError, OverflowError):
+        return None
+
+
+def parse_quantity(value, cast=int):
+    if isinstance(value, str):
+        numbers = re.findall(r'\d[\d,]*(?:\.\d+)?', value)
+        value = numbers[-1] if numbers and value.strip().lower() not in UNKNOWN else None
+    return parse_number(value, cast)
+
+
+def parse_birth_year(value):
+    if not isinstance(value, str):
+        return parse_number(value, float)
+    text = value.strip().upper()
+    sign = -1 if text.endswith('BBY') else 1
+    year = parse_number(text.removesuffix('BBY').removesuffix('ABY'), float)
+    return sign * year if year is not None else None
+
+
+SHADOWS = {
+    'Starships': [
+        ('cost_in_credits', sa.BigInteger(), parse_quantity),
+        ('crew', sa.BigInteger(), parse_quantity),
+        ('max_atmosphering_speed', sa.BigInteger(), parse_quantity),
+        ('hyperdrive_rating', sa.Float(), lambda value: parse_quantity(value, float)),
+        ('MGLT', sa.BigInteger(), parse_quantity),
+        ('cargo_capacity', sa.BigInteger(), parse_quantity),
+    ],
+    'People': [
+        ('birth_year', sa.Float(), parse_birth_year),
+    ],
+}
+
+
+def backfill(table_name, shadows, batch_size=1000):
+    connection = op.get_bind()
+    table = sa.table(table_name, sa.column('id'), *(sa.column(source) for source, _, _ in shadows),
+                     *(sa.column(f'{source}_value') for source, _, _ in shadows))
+    update = table.update().where(table.c.id == sa.bindparam('row_id')).values(
+        {f'{source}_value': sa.bindparam(f'{source}_value') for source, _, _ in shadows})
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(table.c.id, *(table.c[source] for source, _, _ in shadows))
+            .where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)).all()
+        if not rows:
+            break
+        connection.execute(update, [
+            {'row_id': row.id, **{f'{source}_value': parse(row._mapping[source]) for source, _, parse in shadows}}
+            for row in rows])
+        last_id = rows[-1].id
+
+
+def upgrade():
+    for table_name, shadows in SHADOWS.items():
+        with op.batch_alter_table(table_name, schema=None) as batch_op:
+            for source, type_, _ in shadows:
+                batch_op.add_column(sa.Column(f'{source}_value', type_, nullable=True))
+        backfill(table_name, shadows)
+        # indexes go in after the backfill so it does not have to maintain them row by row
+        with op.batch_alter_table(table_name, schema=None) as batch_op:
+            for source, _, _ in shadows:
+                batch_op.create_index(batch_op.f(f'ix_{table_name}_{source}_value'), [f'{source}_value'], unique=False)
+
+
+def downgrade():
+    for table_name, shadows in SHADOWS.items():
+        with op.batch_alter_table(table_name, schema=None) as batch_op:
+            for source, _, _ in shadows:
+                batch_op.drop_index(batch_op.f(f'ix_{table_name}_{source}_value'))
+                batch_op.drop_column(f'{source}_value')
@@ -10,8 +10,10 @@ class AdminView(ModelView):
         for attr_name, attr in model.__mapper__.attrs.items():
             if isinstance(attr, RelationshipProperty):
                 self.column_list.append(attr_name)
+        # numeric shadow columns follow their source column, they are not edited directly
+        derived = {c.key for c in model.__table__.columns if "shadow_of" in c.info}
         self.form_excluded_columns = ["id"]
-        self.form_columns = [col for col in self.column_list if col != "id"]
+        self.form_columns = [col for col in self.column_list if col != "id" and col not in derived]
         super().__init__(model, *args, **kwargs)
 
 def setup_admin(app):
@@ -0,0 +1,49 @@
+"""
+Mounts the Flask-Admin interface without importing it until /admin is requested
+
+ADMIN_MODE=lazy (default) builds it on the first /admin request, eager builds it at startup
+(with gunicorn --preload the workers then share it) and off leaves it out of API-only processes.
+"""
+import os
+import threading
+from flask import Flask
+from models import db
+
+ADMIN_PREFIX = "/admin"
+
+
+class LazyAdmin:
+    # WSGI middleware in front of the API, /admin requests go to a separate Flask app that is built on demand
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self._admin_app = None
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path == ADMIN_PREFIX or path.startswith(ADMIN_PREFIX + "/"):
+            return self.admin_app()(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+    def admin_app(self):
+        with self._lock:
+            if self._admin_app is None:
+                from admin import setup_admin
+                admin_app = Flask(__name__)
+                admin_app.config.update(self.app.config)
+                db.init_app(admin_app)
+                setup_admin(admin_app)
+                self._admin_app = admin_app
+        return self._admin_app
+
+
+def setup_admin_loader(app):
+    mode = os.getenv("ADMIN_MODE", "lazy")
+    if mode == "eager":
+        from admin import setup_admin
+        setup_admin(app)
+    elif mode == "lazy":
+        app.wsgi_app = LazyAdmin(app, app.wsgi_app)
+    elif mode != "off":
+        raise ValueError(f"ADMIN_MODE must be lazy, eager or off, not {mode!r}")
@@ -0,0 +1,262 @@
+"""
+Summary statistics of the catalog numeric columns for /stats/<resource>, computed over an in-memory columnar copy
+
+Every table is loaded once into one array per column, the change events then patch single slots, so a
+write never rescans the table. Writes this process did not see (another worker, `flask catalog load`)
+move the table's version past the one the copy expects, the table is then read again. A field's summary
+is recomputed from its array, vectorized with NumPy when it is installed, the first time it is asked for
+after that column changed. Group counts are kept up to date on every change.
+"""
+import math
+import time
+import bisect
+import threading
+from array import array
+from collections import Counter
+from models import db, People, Planets, Films, Starships
+from versions import table_versions
+import changes
+import metrics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# numeric fields (the name in the response -> column) and the columns the rows are counted by
+STATS_FIELDS = {
+    "characters": (People, {"height": People.height, "mass": People.mass, "birth_year": People.birth_year_value},
+                   ["gender"]),
+    "planets": (Planets, {"population": Planets.population, "diameter": Planets.diameter,
+                          "rotation_period": Planets.rotation_period, "orbital_period": Planets.orbital_period},
+                ["climate", "terrain"]),
+    "starships": (Starships, {"length": Starships.length, "cost_in_credits": Starships.cost_in_credits_value,
+                              "crew": Starships.crew_value, "cargo_capacity": Starships.cargo_capacity_value,
+                              "max_atmosphering_speed": Starships.max_atmosphering_speed_value,
+                              "hyperdrive_rating": Starships.hyperdrive_rating_value, "MGLT": Starships.MGLT_value},
+                  ["starship_class", "manufacturer"]),
+    "films": (Films, {"episode_id": Films.episode_id}, ["director"]),
+}
+PERCENTILES = (25, 50, 75, 90, 95, 99)
+DEFAULT_BINS = 10
+MAX_BINS = 100
+
+
+def percentile(ordered, q):
+    # linear interpolation between the closest ranks, the same as numpy.percentile's default
+    position = (len(ordered) - 1) * q / 100
+    low = math.floor(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def histogram(ordered, bins):
+    # equal width bins from min to max, the last one includes max like numpy.histogram
+    low, high = ordered[0], ordered[-1]
+    if low == high:
+        high = low + 1
+    width = (high - low) / bins
+    edges = [low + width * i for i in range(bins)] + [high]
+    cuts = [bisect.bisect_left(ordered, edge) for edge in edges[1:-1]]
+    counts = [end - start for start, end in zip([0] + cuts, cuts + [len(ordered)])]
+    return edges, counts
+
+
+def summarize_python(values, bins):
+    ordered = sorted(value for value in values if not math.isnan(value))
+    if not ordered:
+        return None
+    edges, counts = histogram(ordered, bins)
+    return {"count": len(ordered), "min": ordered[0], "max": ordered[-1], "mean": math.fsum(ordered) / len(ordered),
+            "percentiles": {f"p{q}": percentile(ordered, q) for q in PERCENTILES},
+            "histogram": {"edges": edges, "counts": counts}}
+
+
+def summarize_numpy(values, bins):
+    # a view on the array's buffer, nothing is copied until the NULLs are dropped
+    column = numpy.frombuffer(values, dtype=numpy.float64)
+    present = column[~numpy.isnan(column)]
+    del column
+    if not present.size:
+        return None
+    low, high = present.min(), present.max()
+    counts, edges = numpy.histogram(present, bins=bins, range=(low, high) if low != high else (low, low + 1))
+    return {"count": int(present.size), "min": float(low), "max": float(high), "mean": float(present.mean()),
+            "percentiles": dict(zip((f"p{q}" for q in PERCENTILES), numpy.percentile(present, PERCENTILES).tolist())),
+            "histogram": {"edges": edges.tolist(), "counts": counts.tolist()}}
+
+
+class ColumnarTable:
+    # one float64 array per numeric field (NaN for NULL) and the group column values, all indexed by row position
+    def __init__(self, model, fields, groups):
+        self.model = model
+        self.fields = fields
+        self.groups = groups
+        self.loaded = False
+        # the table version the copy matches, read before loading and followed by this process's own commits
+        self.version = None
+
+    def load(self):
+        self.version = table_versions.get((self.model.__tablename__,))[0]
+        self.ids = array("q")
+        self.positions = {}
+        self.columns = {name: array("d") for name in self.fields}
+        self.labels = {name: [] for name in self.groups}
+        self.counts = {name: Counter() for name in self.groups}
+        query = db.select(self.model.id, *(column.label(name) for name, column in self.fields.items()),
+                          *(getattr(self.model, name) for name in self.groups)).execution_options(yield_per=5000)
+        for row in db.session.execute(query):
+            self._append(row.id, row._mapping)
+        self.loaded = True
+
+    def _append(self, row_id, values):
+        self.positions[row_id] = len(self.ids)
+        self.ids.append(row_id)
+        for name, column in self.columns.items():
+            column.append(_number(values.get(name)))
+        for name, labels in self.labels.items():
+            labels.append(values.get(name))
+            self.counts[name][values.get(name)] += 1
+
+    def _remove(self, row_id):
+        # the last row moves into the freed slot, the arrays stay dense
+        position = self.positions.pop(row_id)
+        last = len(self.ids) - 1
+        for name, labels in self.labels.items():
+            self._uncount(name, labels[position])
+        if position != last:
+            moved = self.ids[last]
+            self.ids[position] = moved
+            self.positions[moved] = position
+            for column in self.columns.values():
+                column[position] = column[last]
+            for labels in self.labels.values():
+                labels[position] = labels[last]
+        self.ids.pop()
+        for column in self.columns.values():
+            column.pop()
+        for labels in self.labels.values():
+            labels.pop()
+
+    def _uncount(self, name, label):
+        self.counts[name][label] -= 1
+        if not self.counts[name][label]:
+            del self.counts[name][label]
+
+    def apply(self, change):
+        """Patches one row, returns the numeric fields whose values changed"""
+        if change.op == "delete":
+            if change.id not in self.positions:
+                return set()
+            self._remove(change.id)
+            return set(self.fields)
+        if change.id not in self.positions:
+            self._append(change.id, self._row_values(change.values))
+            return set(self.fields)
+        row = self._row_values(change.values)
+        position = self.positions[change.id]
+        touched = set()
+        for name, column in self.columns.items():
+            number = _number(row.get(name))
+            if not (column[position] == number or (math.isnan(number) and math.isnan(column[position]))):
+                column[position] = number
+                touched.add(name)
+        for name, labels in self.labels.items():
+            if labels[position] != row.get(name):
+                self._uncount(name, labels[position])
+                labels[position] = row.get(name)
+                self.counts[name][labels[position]] += 1
+        return touched
+
+    def _row_values(self, values):
+        # change values are keyed by attribute, the response names of the shadow columns differ
+        row = {name: values.get(column.key) for name, column in self.fields.items()}
+        row.update({name: values.get(name) for name in self.groups})
+        return row
+
+
+def _number(value):
+    return math.nan if value is None else float(value)
+
+
+class CatalogStats:
+    def __init__(self):
+        self.tables = {resource: ColumnarTable(*spec) for resource, spec in STATS_FIELDS.items()}
+        self.resources = {model.__tablename__: resource for resource, (model, _, _) in STATS_FIELDS.items()}
+        # (resource, field, bins) -> summary, dropped when that field's column changes
+        self._summaries = {}
+        self._lock = threading.RLock()
+        self.loads = 0
+        self.patched_rows = 0
+        self.computed = 0
+        self.compute_seconds = 0.0
+
+    def apply(self, changed):
+        with self._lock:
+            for table in {change.table for change in changed}:
+                # every commit bumps its tables' versions once
+                if table in self.resources and self.tables[self.resources[table]].loaded:
+                    self.tables[self.resources[table]].version += 1
+            for change in changed:
+                resource = self.resources.get(change.table)
+                if resource is None or not self.tables[resource].loaded:
+                    continue
+                table = self.tables[resource]
+                if change.values is None and change.op != "delete":
+                    # bulk loads and snapshot swaps do not carry the rows, the table is read again when asked for
+                    table.loaded = False
+                    self._forget(resource)
+                    continue
+                touched = table.apply(change)
+                self.patched_rows += 1
+                self._forget(resource, touched)
+
+    def _forget(self, resource, fields=None):
+        for key in [key for key in self._summaries if key[0] == resource and (fields is None or key[1] in fields)]:
+            del self._summaries[key]
+
+    def summary(self, resource, bins=DEFAULT_BINS):
+        summarize = summarize_numpy if numpy is not None else summarize_python
+        with self._lock:
+            table = self.tables[resource]
+            if not table.loaded or table.version != table_versions.get((table.model.__tablename__,))[0]:
+                table.load()
+                self._forget(resource)
+                self.loads += 1
+            fields = {}
+            for name in table.fields:
+                key = (resource, name, bins)
+                if key not in self._summaries:
+                    started = time.perf_counter()
+                    self._summaries[key] = summarize(table.columns[name], bins)
+                    self.compute_seconds += time.perf_counter() - started
+                    self.computed += 1
+                summary = self._summaries[key]
+                fields[name] = dict(summary, missing=len(table.ids) - summary["count"]) if summary else {
+                    "count": 0, "missing": len(table.ids)}
+            return {
+                "resource": resource,
+                "count": len(table.ids),
+                "fields": fields,
+                "groups": {name: dict(table.counts[name].most_common()) for name in table.groups},
+            }
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "numpy" if numpy is not None else "python",
+                    "rows": {resource: len(table.ids) for resource, table in self.tables.items() if table.loaded},
+                    "summaries": len(self._summaries), "loads": self.loads, "patched_rows": self.patched_rows,
+                    "computed": self.computed, "compute_seconds": round(self.compute_seconds, 3)}
+
+
+catalog_stats = CatalogStats()
+
+
+@changes.on_change
+def _patch(changed):
+    catalog_stats.apply(changed)
+
+
+def setup_stats(app):
+    changes.watch(*(model for model, _, _ in STATS_FIELDS.values()))
+    metrics.register("stats", catalog_stats.stats)
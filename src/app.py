@@ -2,41 +2,105 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
+import click
+from flask import Flask, Blueprint, request, jsonify, url_for, stream_with_context, current_app
+from flask.cli import ScriptInfo
 from flask_cors import CORS,cross_origin
 from utils import APIException, generate_sitemap
-from admin import setup_admin
-from models import db, User, Favorites, Films, Planets, People,Starships
+from admin_loader import setup_admin_loader
+from models import db, User, Favorites, Films, Planets, People,Starships, FavoriteTypeEnum
+from catalog import list_page, parse_int_arg
+from cache import cached, setup_cache
+from shared_cache import setup_shared_cache
+from versions import conditional
+from serializer import FastJSONProvider, stream_list, encoder_for
+from export import export_response, wants_ndjson
+from expand import requested_expansions, expand_homeworlds, expand_favorite_targets
+from favorites import add_favorites, remove_favorites
+from favorites_cache import favorites_cache, setup_favorites_cache
+from instrumentation import setup_query_count, setup_profiling, prometheus_text
+from commands import setup_commands
+from pool import engine_options, setup_pool_metrics
+from replicas import read_only, setup_replicas
+from hashing import password_hasher, setup_hashing, HasherBusy
+from search import search_index, setup_search, MODELS_BY_TABLE
+from snapshot import from_snapshot, setup_snapshot
+from batch import batch_paths, batch_response
+from aggregates import catalog_stats, setup_stats, STATS_FIELDS, DEFAULT_BINS, MAX_BINS
+from compression import setup_compression
+from events import event_stream, setup_events
+from metrics import collect, internal_only
 from flask_jwt_extended import create_access_token, get_csrf_token, jwt_required, JWTManager, set_access_cookies, unset_jwt_cookies, get_jwt_identity
 from sqlalchemy import or_
-import bcrypt
+from sqlalchemy.exc import IntegrityError
 
-app = Flask(__name__)
-app.url_map.strict_slashes = False
-
-db_url = os.getenv("DATABASE_URL")
-if db_url is not None:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-app.config["JWT_SECRET_KEY"] = ("super-secret")
-app.config["JWT_TOKEN_LOCATION"] = ["cookies"]
-app.config["JWT_COOKIE_CSRF_PROTECT"] = True
-app.config["JWT_CSRF_IN_COOKIES"] = True
-app.config["JWT_COOKIE_SECURE"] = True 
-
-jwt = JWTManager(app)
-
-app.config['CORS_HEADERS'] = 'Content-Type'
-CORS(app, supports_credentials=True, resources={r"/*": {"origins": "*"}})
+api = Blueprint("api", __name__)
 
 FavoriteType=["People","Planets","Films","Starships"]
 
-@app.route("/register", methods=["POST"])
+EXPORTS = {"characters": People, "films": Films, "planets": Planets, "starships": Starships}
+
+def running_flask_cli():
+    # `flask db ...` and the other flask commands, not gunicorn or uvicorn workers
+    context = click.get_current_context(silent=True)
+    return context is not None and context.find_object(ScriptInfo) is not None
+
+
+def create_app():
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+    app.url_map.strict_slashes = False
+
+    db_url = os.getenv("DATABASE_URL")
+    if db_url is not None:
+        app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
+    else:
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['CACHE_MAX_ENTRIES'] = int(os.getenv("CACHE_MAX_ENTRIES", 1024))
+    app.config['CACHE_TTL'] = int(os.getenv("CACHE_TTL", 300))
+    app.config['QUERY_COUNT_HEADER'] = os.getenv("QUERY_COUNT_HEADER") == "1"
+
+    app.config["JWT_SECRET_KEY"] = ("super-secret")
+    app.config["JWT_TOKEN_LOCATION"] = ["cookies"]
+    app.config["JWT_COOKIE_CSRF_PROTECT"] = True
+    app.config["JWT_CSRF_IN_COOKIES"] = True
+    app.config["JWT_COOKIE_SECURE"] = True 
+
+    JWTManager(app)
+
+    app.config['CORS_HEADERS'] = 'Content-Type'
+    CORS(app, supports_credentials=True, resources={r"/*": {"origins": "*"}})
+
+    if running_flask_cli():
+        # alembic is the slowest import of the app, only the migration commands need it
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    db.init_app(app)
+    app.config['CORS_HEADERS'] = 'Content-Type'
+    CORS(app, supports_credentials=True)
+
+    setup_admin_loader(app)
+    setup_cache(app, People, Planets, Films, Starships)
+    setup_shared_cache(app)
+    setup_query_count(app)
+    setup_profiling(app)
+    setup_commands(app)
+    setup_pool_metrics(app, db)
+    setup_replicas(app)
+    setup_hashing(app)
+    setup_search(app)
+    setup_stats(app)
+    setup_favorites_cache(app)
+    setup_snapshot(app)
+    setup_compression(app)
+    setup_events(app)
+    app.register_blueprint(api)
+    return app
+
+
+@api.route("/register", methods=["POST"])
 def register():
     data = request.get_json()
     username = data.get("username")
@@ -54,7 +118,7 @@ def register():
     if existing_user:
         return jsonify({"error": "Username or Email already registered"}), 400
 
-    hashedPassword = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    hashedPassword = password_hasher.hash(password)
 
     new_user = User(username=username, email=email, password=hashedPassword,first_name=first_name,last_name=last_name)
     db.session.add(new_user)
@@ -63,7 +127,7 @@ def register():
     return jsonify({"message": "User registered successfully"}), 201
 
 
-@app.route("/login", methods=["POST"])
+@api.route("/login", methods=["POST"])
 def get_login():
     data = request.get_json()
 
@@ -78,11 +142,19 @@ def get_login():
     if not user1:
         return jsonify({"error": "User not found"}), 400
 
-    is_password_valid = bcrypt.checkpw(password.encode('utf-8'), user1.password.encode('utf-8'))
+    is_password_valid = password_hasher.check(password, user1.password)
 
     if not is_password_valid:
         return jsonify({"error": "Password not correct"}), 400
 
+    if password_hasher.needs_rehash(user1.password):
+        # BCRYPT_ROUNDS changed since this hash was made, upgrade it while we have the password
+        try:
+            user1.password = password_hasher.hash(password)
+            db.session.commit()
+        except HasherBusy:
+            pass
+
     access_token = create_access_token(identity=str(user1.id))
     csrf_token = get_csrf_token(access_token)
     response = jsonify({
@@ -94,95 +166,189 @@ def get_login():
 
     return response
     
-@app.route("/logout", methods=["POST"])
+@api.route("/logout", methods=["POST"])
 @jwt_required()
 def logout_with_cookies():
     response = jsonify({"msg": "logout successful"})
     unset_jwt_cookies(response)
     return response
 
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-app.config['CORS_HEADERS'] = 'Content-Type'
-CORS(app, supports_credentials=True)
-
-
-setup_admin(app)
-
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
+@api.app_errorhandler(APIException)
 def handle_invalid_usage(error):
-    return jsonify(error.to_dict()), error.status_code
+    response = jsonify(error.to_dict())
+    if getattr(error, "retry_after", None) is not None:
+        response.headers["Retry-After"] = str(error.retry_after)
+    return response, error.status_code
 
 # generate sitemap with all your endpoints
-@app.route('/')
+@api.route('/')
 def sitemap():
-    return generate_sitemap(app)
-
-
-@app.route('/characters', methods=['GET'])
+    return generate_sitemap(current_app)
+
+@api.route('/internal/stats', methods=['GET'])
+@internal_only
+def get_internal_stats():
+    return jsonify(collect()), 200
+
+@api.route('/metrics', methods=['GET'])
+@internal_only
+def get_metrics():
+    return current_app.response_class(prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+@api.before_app_request
+def negotiate_ndjson():
+    # list routes answer Accept: application/x-ndjson with the full export, before the cache sees the request
+    if request.method == "GET" and request.path.strip("/") in EXPORTS and wants_ndjson():
+        return export_catalog(request.path.strip("/"))
+
+@api.route('/export/<resource>', methods=['GET'])
+@read_only
+def export_catalog(resource):
+    if resource not in EXPORTS:
+        return jsonify({"error": "Unknown resource"}), 404
+    return export_response(EXPORTS[resource])
+
+
+@api.route('/characters', methods=['GET'])
+@read_only
+@conditional(People, Planets)
+@from_snapshot(People)
+@cached(People, Planets)
 def get_all_characters():
-    all_characters= People.query.all()
-    return jsonify(all_characters), 200
-
-@app.route("/characters/<int:id>", methods=["GET"])
+    expansions = requested_expansions(request.args, ["homeworld"])
+    page = list_page(People, request.args)
+    if "homeworld" in expansions:
+        expand_homeworlds(page["results"])
+    return jsonify(page), 200
+
+@api.route("/characters/<int:id>", methods=["GET"])
+@read_only
+@conditional(People, Planets)
+@from_snapshot(People)
+@cached(People, Planets)
 def  get_single_character(id):
+    expansions = requested_expansions(request.args, ["homeworld"])
     character = People.query.get(id)
     response_body = character
+    if character and "homeworld" in expansions:
+        response_body = expand_homeworlds([encoder_for(People)(character)])[0]
     return jsonify(response_body), 200
 
-@app.route('/films', methods=['GET'])
+@api.route('/films', methods=['GET'])
+@read_only
+@conditional(Films)
+@from_snapshot(Films)
+@cached(Films)
 def get_films():
-    all_films= Films.query.all()
-    return jsonify(all_films), 200
+    return jsonify(list_page(Films, request.args)), 200
 
-@app.route("/films/<int:id>", methods=["GET"])
+@api.route("/films/<int:id>", methods=["GET"])
+@read_only
+@conditional(Films)
+@from_snapshot(Films)
+@cached(Films)
 def  get_single_film(id):
     film = Films.query.get(id)
     response_body = film
     return jsonify(response_body), 200
 
-@app.route('/planets', methods=['GET'])
+@api.route('/planets', methods=['GET'])
+@read_only
+@conditional(Planets)
+@from_snapshot(Planets)
+@cached(Planets)
 def get_planets():
-    all_planets= Planets.query.all()
-    
-    return jsonify(all_planets), 200
+    return jsonify(list_page(Planets, request.args)), 200
 
-@app.route("/planets/<int:id>", methods=["GET"])
+@api.route("/planets/<int:id>", methods=["GET"])
+@read_only
+@conditional(Planets)
+@from_snapshot(Planets)
+@cached(Planets)
 def  get_single_planet(id):
     planet = Planets.query.get(id)
     return jsonify(planet), 200
 
-@app.route('/starships', methods=['GET'])
+@api.route('/starships', methods=['GET'])
+@read_only
+@conditional(Starships)
+@from_snapshot(Starships)
+@cached(Starships)
 def get_starships():
-    all_planets= Starships.query.all()
-    
-    return jsonify(all_planets), 200
+    return jsonify(list_page(Starships, request.args)), 200
 
-@app.route("/starships/<int:id>", methods=["GET"])
+@api.route("/starships/<int:id>", methods=["GET"])
+@read_only
+@conditional(Starships)
+@from_snapshot(Starships)
+@cached(Starships)
 def  get_single_starship(id):
     planet = Starships.query.get(id)
     return jsonify(planet), 200
 
-@app.route('/user', methods=['GET'])
+@api.route('/search', methods=['GET'])
+@read_only
+def search_catalog():
+    query = request.args.get("q", "").strip()
+    if len(query) < 2:
+        return jsonify({"error": "'q' needs at least 2 characters"}), 400
+    types = [name for name in request.args.get("type", "").split(",") if name]
+    if any(name not in MODELS_BY_TABLE for name in types):
+        return jsonify({"error": f"'type' must be one of {', '.join(MODELS_BY_TABLE)}"}), 400
+    limit = min(parse_int_arg(request.args, "limit", 20), 100)
+    return jsonify({"results": search_index.search(query, set(types), limit)}), 200
+
+@api.route('/stats/<resource>', methods=['GET'])
+@read_only
+@conditional(People, Planets, Films, Starships)
+def get_catalog_stats(resource):
+    if resource not in STATS_FIELDS:
+        return jsonify({"error": "Unknown resource"}), 404
+    bins = parse_int_arg(request.args, "bins", DEFAULT_BINS)
+    if bins < 1 or bins > MAX_BINS:
+        return jsonify({"error": f"'bins' must be between 1 and {MAX_BINS}"}), 400
+    return jsonify(catalog_stats.summary(resource, bins)), 200
+
+@api.route('/batch', methods=['POST'])
+@read_only
+def get_batch():
+    paths = batch_paths(request.get_json(silent=True))
+    return current_app.response_class(batch_response(paths), mimetype="application/json")
+
+@api.route('/events', methods=['GET'])
+def get_events():
+    return event_stream(current_app.config["EVENTS_HEARTBEAT"])
+
+@api.route('/user', methods=['GET'])
+@read_only
 def get_users():
-    all_users= User.query.all()
-    return jsonify(all_users), 200
-
-@app.route("/user/<int:user_id>", methods=["GET"])
+    @stream_with_context
+    def generate():
+        # the query has to run inside the generator, the view's session is closed by then
+        all_users = db.session.execute(db.select(User).execution_options(yield_per=500)).scalars()
+        yield from stream_list(all_users)
+    return current_app.response_class(generate(), mimetype="application/json"), 200
+
+@api.route("/user/<int:user_id>", methods=["GET"])
+@read_only
 def  get_single_user(user_id):
     user = User.query.get(user_id)
     response_body = user
     return jsonify(response_body), 200
 
-@app.route('/favorites', methods=['GET'])
+@api.route('/favorites', methods=['GET'])
 @jwt_required()
 def get_favorites():
     user_id=get_jwt_identity()
-    favorites = Favorites.query.filter_by(user_id=user_id).all()
+    expansions = requested_expansions(request.args, ["target"])
+    if "target" in expansions:
+        favorites = Favorites.query.filter_by(user_id=user_id).all()
+        return jsonify(expand_favorite_targets(favorites)), 200
+    favorites = favorites_cache.get(int(user_id), lambda: Favorites.query.filter_by(user_id=user_id).all())
     return jsonify(favorites), 200
 
-@app.route('/favorites', methods=['POST'])
+@api.route('/favorites', methods=['POST'])
 @jwt_required()
 def add_favorite():
     user_id=get_jwt_identity()
@@ -191,6 +357,14 @@ def add_favorite():
     if not all(field in data for field in required_fields):
         return jsonify({"error": "Missing required fields"}), 400
     
+    if data["type"] not in FavoriteTypeEnum.__members__:
+        return jsonify({"error": "Invalid favorite type"}), 400
+
+    # adding the same favorite twice returns the existing row instead of a duplicate
+    existing = Favorites.query.filter_by(user_id=user_id, type=data["type"], external_id=data["external_id"]).first()
+    if existing:
+        return jsonify(existing), 200
+
     new_favorite = Favorites(
         user_id=user_id,
         external_id=data["external_id"],
@@ -198,16 +372,21 @@ def add_favorite():
         type=data["type"]
     )
     db.session.add(new_favorite)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # a concurrent request inserted it first
+        db.session.rollback()
+        existing = Favorites.query.filter_by(user_id=user_id, type=data["type"], external_id=data["external_id"]).first()
+        return jsonify(existing), 200
     return jsonify(new_favorite), 201
 
-@app.route('/favorites/<int:id>', methods=['DELETE'])
+@api.route('/favorites/<int:id>', methods=['DELETE'])
 @jwt_required()
 def delete_favorite(id):
     user_id=get_jwt_identity()
-    data = request.get_json()
     favorite = Favorites.query.filter_by(
-            id=data["id"], user_id=user_id
+            id=id, user_id=user_id
         ).first()
     if not favorite:
         return jsonify({"error": "Favorite not found"}), 404
@@ -215,9 +394,20 @@ def delete_favorite(id):
     db.session.commit()
     return jsonify({"message": "Favorite deleted successfully"}), 200
 
+@api.route('/favorites/batch', methods=['POST'])
+@jwt_required()
+def add_favorites_batch():
+    user_id=get_jwt_identity()
+    return jsonify({"results": add_favorites(int(user_id), request.get_json())}), 200
+
+@api.route('/favorites/batch', methods=['DELETE'])
+@jwt_required()
+def delete_favorites_batch():
+    user_id=get_jwt_identity()
+    return jsonify({"results": remove_favorites(int(user_id), request.get_json())}), 200
 
 
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
@@ -0,0 +1,365 @@
+"""
+ASGI entry point: the catalog and favorites reads run as async handlers on an async SQLAlchemy engine,
+every other request (admin, login, register, writes, exports) is handed to the Flask app on a pool of
+ASGI_FALLBACK_THREADS (8) threads.
+
+    uvicorn asgi:application --app-dir src --workers 4 --timeout-graceful-shutdown 10
+
+/events streams are served here too, as coroutines (see events). uvicorn waits for open responses
+before it exits, the timeout keeps the streams from holding up a restart.
+
+The async handlers share the query building, ETags, response cache, catalog snapshot, compression
+and favorites cache with the Flask views, so both answer the same URL with the same body and
+validators. They do not go through Flask itself, which leaves these differences:
+
+- every read goes to the primary, DATABASE_REPLICA_URLS and the sticky cookie are ignored
+- no before/after_request hooks: no X-Query-Count, Server-Timing or per-endpoint stats, no sampled profiles
+- CORS headers are added by respond(), not flask-cors, only Access-Control-Allow-Origin/-Credentials
+"""
+import os
+import re
+import queue
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask_jwt_extended import decode_token
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_cookie, parse_etags, parse_date, http_date
+from app import create_app
+from models import People, Planets, Films, Starships, Favorites
+from catalog import list_query, build_page, sorted_queries, build_sorted_page
+from expand import requested_expansions, homeworld_query, attach_homeworlds, favorite_target_queries, attach_favorite_targets
+from cache import response_cache, cache_key
+from favorites_cache import favorites_cache
+from versions import table_versions, compute_etag, is_not_modified
+from snapshot import catalog_snapshot
+from compression import compressor, compressed_body, variant_etag
+from serializer import dumps, encoder_for
+from export import NDJSON_MIMETYPE
+from events import (event_broker, Subscriber, RESET, KEEPALIVE, RETRY_SECONDS, STREAM_HEADERS, parse_last_event_id,
+                    stream_types, wants_favorites, favorite_keys)
+from utils import APIException
+
+RESOURCES = {"characters": People, "films": Films, "planets": Planets, "starships": Starships}
+LIST_ROUTE = re.compile(r"^/(characters|films|planets|starships)/?$")
+ITEM_ROUTE = re.compile(r"^/(characters|films|planets|starships)/(\d+)/?$")
+FAVORITES_ROUTE = re.compile(r"^/favorites/?$")
+EVENTS_ROUTE = re.compile(r"^/events/?$")
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def async_database_url(url):
+    scheme, rest = url.split("://", 1)
+    return f"{ASYNC_DRIVERS.get(scheme.split('+')[0], scheme)}://{rest}"
+
+
+class Request:
+    def __init__(self, scope):
+        self.path = scope["path"]
+        self.query_string = scope.get("query_string", b"").decode("latin-1")
+        self.args = MultiDict(parse_qsl(self.query_string, keep_blank_values=True))
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        # set by conditional_cached, compression keys the compressed bodies by them
+        self.etag = None
+        self.conditional_tables = None
+
+    @property
+    def full_path(self):
+        # same shape as flask.Request.full_path so both modes produce the same ETags
+        return f"{self.path}?{self.query_string}"
+
+
+class AsyncSubscriber(Subscriber):
+    # the broker delivers from whichever thread committed, the stream waits on the event loop
+    def __init__(self, types, user_id, favorites, buffer_size, loop):
+        super().__init__(types, user_id, favorites, buffer_size)
+        self.loop = loop
+        self.ready = asyncio.Event()
+
+    def offer(self, data):
+        super().offer(data)
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+
+class PooledWsgiToAsgiInstance(WsgiToAsgiInstance):
+    def __init__(self, wsgi_application, executor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):
+        run = WsgiToAsgiInstance.__dict__["run_wsgi_app"].func
+        await sync_to_async(run, thread_sensitive=False, executor=self.executor)(self, body)
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    # WsgiToAsgi runs every request on asgiref's one thread-sensitive thread, a slow login would hold
+    # up every other fallback request of the worker: these run side by side on a bounded pool
+    def __init__(self, wsgi_application, threads):
+        super().__init__(wsgi_application)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="wsgi-fallback")
+
+    async def __call__(self, scope, receive, send):
+        await PooledWsgiToAsgiInstance(self.wsgi_application, self.executor)(scope, receive, send)
+
+
+class AsyncAPI:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.fallback = PooledWsgiToAsgi(wsgi_app, int(os.getenv("ASGI_FALLBACK_THREADS", 8)))
+        pool_options = {key: value for key, value in wsgi_app.config["SQLALCHEMY_ENGINE_OPTIONS"].items() if key != "poolclass"}
+        self.engine = create_async_engine(async_database_url(wsgi_app.config["SQLALCHEMY_DATABASE_URI"]), **pool_options)
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return await self.fallback(scope, receive, send)
+
+        request = Request(scope)
+        if NDJSON_MIMETYPE in request.headers.get("accept", ""):
+            return await self.fallback(scope, receive, send)
+
+        if EVENTS_ROUTE.match(request.path):
+            try:
+                return await self.events(request, receive, send)
+            except APIException as error:
+                return await self.respond(send, request, *self.error_response(error))
+
+        handler, params = self.route(request.path)
+        if handler is None:
+            return await self.fallback(scope, receive, send)
+        try:
+            status, body, headers = await handler(request, *params)
+        except APIException as error:
+            status, body, headers = self.error_response(error)
+        body, headers = self.compress(request, status, body, headers)
+        await self.respond(send, request, status, body, headers)
+
+    def route(self, path):
+        match = LIST_ROUTE.match(path)
+        if match:
+            return self.catalog_list, (RESOURCES[match.group(1)],)
+        match = ITEM_ROUTE.match(path)
+        if match:
+            return self.catalog_item, (RESOURCES[match.group(1)], int(match.group(2)))
+        if FAVORITES_ROUTE.match(path):
+            return self.favorites, ()
+        return None, ()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                self.fallback.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def error_response(self, error):
+        headers = []
+        if getattr(error, "retry_after", None) is not None:
+            headers.append((b"retry-after", str(error.retry_after).encode()))
+        return error.status_code, dumps(error.to_dict()) + b"\n", headers
+
+    def cors_headers(self, request):
+        origin = request.headers.get("origin")
+        if not origin:
+            return []
+        # mirrors flask-cors with supports_credentials=True and origins="*"
+        return [(b"access-control-allow-origin", origin.encode("latin-1")),
+                (b"access-control-allow-credentials", b"true"), (b"vary", b"Origin")]
+
+    async def respond(self, send, request, status, body, headers):
+        headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())] + headers
+        headers += self.cors_headers(request)
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    def compress(self, request, status, body, headers):
+        # the same negotiation and per-ETag compressed bodies as compression.setup_compression
+        if not compressor.encodings:
+            return body, headers
+        headers = headers + [(b"vary", b"Accept-Encoding")]
+        encoding = compressor.negotiate(request.headers.get("accept-encoding"))
+        if encoding is None:
+            return body, headers
+        tables, etag = request.conditional_tables, request.etag
+        if status == 304:
+            if etag and parse_etags(request.headers.get("if-none-match")).contains(variant_etag(etag, encoding)):
+                headers = self.replace_etag(headers, variant_etag(etag, encoding))
+            return body, headers
+        if status != 200 or len(body) < compressor.min_size:
+            return body, headers
+        if not tables or compute_etag(tables, request.full_path) != etag:
+            tables = None
+        body = compressed_body(encoding, body, etag if tables else None, tables)
+        if etag:
+            headers = self.replace_etag(headers, variant_etag(etag, encoding))
+        return body, headers + [(b"content-encoding", encoding.encode())]
+
+    def replace_etag(self, headers, etag):
+        return [(name, f'"{etag}"'.encode()) if name == b"etag" else (name, value) for name, value in headers]
+
+    async def conditional_cached(self, request, models, build_body, snapshot=None):
+        # the same ETag, 304, snapshot and response cache logic as the conditional, from_snapshot and cached decorators
+        tables = tuple(model.__tablename__ for model in models)
+        etag = compute_etag(tables, request.full_path)
+        request.etag, request.conditional_tables = etag, tables
+        last_modified = int(table_versions.last_modified(tables))
+        headers = [(b"etag", f'"{etag}"'.encode()), (b"last-modified", http_date(last_modified).encode()),
+                   (b"cache-control", b"no-cache")]
+        if_none_match = parse_etags(request.headers.get("if-none-match"))
+        if_modified_since = parse_date(request.headers.get("if-modified-since"))
+        if is_not_modified(etag, last_modified, if_none_match, if_modified_since):
+            return 304, b"", headers
+
+        body = snapshot() if snapshot is not None else None
+        if body is not None:
+            return 200, body, headers + [(b"x-snapshot", b"HIT")]
+        key = cache_key(request.path, request.args)
+        body = response_cache.get(key) if response_cache.enabled else None
+        if body is not None:
+            return 200, body, headers + [(b"x-cache", b"HIT")]
+        versions = table_versions.get(tables)
+        body = await build_body()
+        if response_cache.enabled:
+            response_cache.set(key, tables, versions, body)
+        return 200, body, headers + [(b"x-cache", b"MISS")]
+
+    async def catalog_list(self, request, model):
+        expansions = requested_expansions(request.args, ["homeworld"]) if model is People else set()
+
+        async def build_body():
+            async with self.sessions() as session:
+                if request.args.get("sort"):
+                    page = await self.sorted_page(session, model, request.args)
+                else:
+                    query, limit = list_query(model, request.args)
+                    page = build_page((await session.execute(query)).all(), limit)
+                if "homeworld" in expansions:
+                    await self.expand_homeworlds(session, page["results"])
+            return dumps(page) + b"\n"
+
+        models = (People, Planets) if model is People else (model,)
+        return await self.conditional_cached(request, models, build_body,
+                                             lambda: catalog_snapshot.response_body(model, request.args))
+
+    async def sorted_page(self, session, model, args):
+        # catalog.sorted_page on the async session
+        values, nulls, limit = sorted_queries(model, args)
+        rows = (await session.execute(values)).all() if values is not None else []
+        if nulls is not None and len(rows) <= limit:
+            rows += (await session.execute(nulls.limit(limit + 1 - len(rows)))).all()
+        return build_sorted_page(rows, limit)
+
+    async def catalog_item(self, request, model, item_id):
+        expansions = requested_expansions(request.args, ["homeworld"]) if model is People else set()
+
+        async def build_body():
+            async with self.sessions() as session:
+                item = await session.get(model, item_id)
+                if item is not None and "homeworld" in expansions:
+                    item = (await self.expand_homeworlds(session, [encoder_for(People)(item)]))[0]
+            return dumps(item) + b"\n"
+
+        models = (People, Planets) if model is People else (model,)
+        return await self.conditional_cached(request, models, build_body,
+                                             lambda: catalog_snapshot.response_body(model, request.args, item_id))
+
+    async def expand_homeworlds(self, session, characters):
+        query = homeworld_query(characters)
+        planets = (await session.execute(query)).scalars().all() if query is not None else []
+        return attach_homeworlds(characters, planets)
+
+    def jwt_identity(self, request, optional=False):
+        cookies = parse_cookie(request.headers.get("cookie", ""))
+        token = cookies.get(self.wsgi_app.config["JWT_ACCESS_COOKIE_NAME"])
+        if not token:
+            if optional:
+                return None
+            raise APIException(f'Missing cookie "{self.wsgi_app.config["JWT_ACCESS_COOKIE_NAME"]}"', status_code=401)
+        with self.wsgi_app.app_context():
+            try:
+                return decode_token(token)[self.wsgi_app.config["JWT_IDENTITY_CLAIM"]]
+            except Exception:
+                raise APIException("Invalid token", status_code=422)
+
+    async def cached_favorites(self, user_id):
+        # favorites_cache.get on the async session, the user's encoded favorites
+        favorites = favorites_cache.lookup(user_id)
+        if favorites is None:
+            generation = favorites_cache.generation()
+            async with self.sessions() as session:
+                rows = (await session.execute(select(Favorites).where(Favorites.user_id == user_id))).scalars().all()
+            favorites = favorites_cache.store(user_id, rows, generation)
+        return favorites
+
+    async def favorites(self, request):
+        # asyncpg does not coerce the string identity like psycopg2 does
+        user_id = int(self.jwt_identity(request))
+        expansions = requested_expansions(request.args, ["target"])
+        if "target" not in expansions:
+            return 200, dumps(await self.cached_favorites(user_id)) + b"\n", []
+        async with self.sessions() as session:
+            query = select(Favorites).where(Favorites.user_id == user_id)
+            favorites = (await session.execute(query)).scalars().all()
+            targets = {}
+            for favorite_type, query in favorite_target_queries(favorites):
+                for target in (await session.execute(query)).scalars():
+                    targets[(favorite_type, target.id)] = target
+        return 200, dumps(attach_favorite_targets(favorites, targets)) + b"\n", []
+
+    async def events(self, request, receive, send):
+        # events.event_stream on the event loop: a stream is a coroutine waiting on its queue, not a thread
+        types = stream_types(request.args)
+        identity = self.jwt_identity(request, optional=True)
+        user_id = int(identity) if identity is not None else None
+        favorites = None
+        if wants_favorites(request.args, user_id):
+            favorites = favorite_keys(await self.cached_favorites(user_id))
+        subscriber = AsyncSubscriber(types, user_id, favorites, event_broker.buffer_size, asyncio.get_running_loop())
+        missed = event_broker.subscribe(subscriber, parse_last_event_id(
+            request.headers.get("last-event-id") or request.args.get("last_event_id")))
+        # an ASGI server does not fail a send to a closed connection, the disconnect has to be received
+        disconnected = asyncio.ensure_future(self.disconnect(receive))
+        try:
+            headers = [(b"content-type", b"text/event-stream; charset=utf-8")] + self.cors_headers(request)
+            headers += [(name.lower().encode(), value.encode()) for name, value in STREAM_HEADERS.items()]
+            await send({"type": "http.response.start", "status": 200, "headers": headers})
+            for data in [b"retry: %d\n\n" % (RETRY_SECONDS * 1000)] + missed:
+                await send({"type": "http.response.body", "body": data, "more_body": True})
+            heartbeat = self.wsgi_app.config["EVENTS_HEARTBEAT"]
+            while not disconnected.done():
+                try:
+                    data = subscriber.queue.get_nowait()
+                except queue.Empty:
+                    if subscriber.overflowed:
+                        # everything buffered was sent, the client reconnects and resumes from the history
+                        await send({"type": "http.response.body", "body": RESET})
+                        return
+                    ready = asyncio.ensure_future(subscriber.ready.wait())
+                    done, _ = await asyncio.wait({ready, disconnected}, timeout=heartbeat,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    ready.cancel()
+                    subscriber.ready.clear()
+                    data = KEEPALIVE if not done else None
+                if data is not None:
+                    await send({"type": "http.response.body", "body": data, "more_body": True})
+        finally:
+            event_broker.unsubscribe(subscriber)
+            disconnected.cancel()
+
+    async def disconnect(self, receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+
+application = AsyncAPI(create_app())
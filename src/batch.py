@@ -0,0 +1,117 @@
+"""
+POST /batch: several GET paths answered in one round trip
+
+    {"requests": ["/characters/1", "/planets/3", {"resource": "films", "ids": [1, 2, 3]}, "/favorites"]}
+
+Paths are matched against the app's URL map. Plain item lookups are merged into one
+`WHERE id IN (...)` query per model, the other JSON reads in DISPATCHED_ENDPOINTS run their view
+function directly in a request context that carries the caller's cookies, so /favorites sees the
+same JWT. Nothing goes through WSGI or the before/after request hooks again. Any other route
+(exports, /events, writes) and any streamed response is answered 400.
+The response maps every path to {"status": ..., "body": ...}, in request order.
+"""
+from flask import request, current_app
+from werkzeug.exceptions import HTTPException
+from models import db, People, Planets, Films, Starships
+from serializer import dumps, encoder_for
+from utils import APIException
+
+MAX_PATHS = 50
+# the single item routes whose lookups are merged, they answer a missing row with null
+ITEM_ENDPOINTS = {
+    "api.get_single_character": People,
+    "api.get_single_film": Films,
+    "api.get_single_planet": Planets,
+    "api.get_single_starship": Starships,
+}
+# views answering with one JSON body, a batch never runs anything else
+DISPATCHED_ENDPOINTS = set(ITEM_ENDPOINTS) | {
+    "api.get_all_characters", "api.get_films", "api.get_planets", "api.get_starships",
+    "api.search_catalog", "api.get_catalog_stats", "api.get_favorites", "api.get_single_user",
+}
+RESOURCE_PATHS = {"characters", "films", "planets", "starships"}
+FORWARDED_HEADERS = ("Cookie", "Authorization")
+
+
+def batch_paths(data):
+    entries = data.get("requests") if isinstance(data, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise APIException("'requests' must be a non-empty list", status_code=400)
+    paths = []
+    for entry in entries:
+        if isinstance(entry, str) and entry.startswith("/"):
+            paths.append(entry)
+        elif isinstance(entry, dict) and entry.get("resource") in RESOURCE_PATHS and isinstance(entry.get("ids"), list):
+            paths.extend(f"/{entry['resource']}/{item_id}" for item_id in entry["ids"])
+        else:
+            raise APIException("every request is a path or {\"resource\", \"ids\"}", status_code=400)
+    # a path asked for twice is answered once
+    paths = list(dict.fromkeys(paths))
+    if len(paths) > MAX_PATHS:
+        raise APIException(f"At most {MAX_PATHS} paths per batch", status_code=400)
+    return paths
+
+
+def error_body(status, message):
+    return status, dumps({"error": message})
+
+
+def merged_items(lookups):
+    """{path: (status, body)} for (path, model, id) lookups, one query per model"""
+    by_model = {}
+    for path, model, item_id in lookups:
+        by_model.setdefault(model, {}).setdefault(item_id, []).append(path)
+    answers = {}
+    for model, paths_by_id in by_model.items():
+        encode = encoder_for(model)
+        rows = db.session.execute(db.select(model).where(model.id.in_(list(paths_by_id)))).scalars()
+        found = {row.id: dumps(encode(row)) for row in rows}
+        for item_id, paths in paths_by_id.items():
+            for path in paths:
+                answers[path] = (200, found.get(item_id, b"null"))
+    return answers
+
+
+def dispatch(path, endpoint, view_args):
+    headers = {name: request.headers[name] for name in FORWARDED_HEADERS if name in request.headers}
+    with current_app.test_request_context(path, headers=headers):
+        try:
+            response = current_app.make_response(current_app.view_functions[endpoint](**view_args))
+        except Exception as error:
+            # the app's error handlers turn APIException and HTTP errors into the usual JSON
+            response = current_app.make_response(current_app.handle_user_exception(error))
+        if response.is_streamed:
+            # reading it would buffer the whole stream, or never end
+            response.close()
+            return error_body(400, "Streamed responses are not available in a batch")
+        body = response.get_data().strip()
+        if response.mimetype != "application/json":
+            body = dumps(body.decode("utf-8", "replace"))
+        return response.status_code, body or b"null"
+
+
+def batch_response(paths):
+    adapter = current_app.url_map.bind(request.host)
+    answers, lookups, dispatched = {}, [], []
+    for path in paths:
+        route, _, query = path.partition("?")
+        try:
+            endpoint, view_args = adapter.match(route, method="GET")
+        except HTTPException as error:
+            answers[path] = error_body(error.code, error.description)
+            continue
+        if endpoint not in DISPATCHED_ENDPOINTS:
+            answers[path] = error_body(400, "Not available in a batch")
+        elif endpoint in ITEM_ENDPOINTS and not query:
+            lookups.append((path, ITEM_ENDPOINTS[endpoint], view_args["id"]))
+        else:
+            dispatched.append((path, endpoint, view_args))
+
+    answers.update(merged_items(lookups))
+    for path, endpoint, view_args in dispatched:
+        answers[path] = dispatch(path, endpoint, view_args)
+
+    # the bodies are already JSON, they are spliced in instead of being parsed and encoded again
+    parts = [dumps(path) + b':{"status":' + str(answers[path][0]).encode() + b',"body":' + answers[path][1] + b"}"
+             for path in paths]
+    return b'{"responses":{' + b",".join(parts) + b"}}\n"
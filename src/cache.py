@@ -0,0 +1,139 @@
+"""
+Read-through cache of serialized catalog responses, invalidated when the catalog tables change
+"""
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import request, current_app, make_response
+import changes
+import metrics
+from versions import table_versions
+from replicas import may_be_stale
+
+
+class ResponseCache:
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = True
+        # a shared_cache.SharedSegment when SHARED_CACHE_PATH is set, entries then live there for every worker
+        self.shared = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        if self.shared is not None:
+            body = self.shared.get(repr(key).encode("utf-8"))
+            with self._lock:
+                if body is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            return body
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            tables, expires, body = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def set(self, key, tables, versions, body):
+        if self.shared is not None:
+            # the generations in versions are stored with the body, a later bump makes it stale in every worker
+            self.shared.set(repr(key).encode("utf-8"), tables, versions, body, self.ttl)
+            return
+        with self._lock:
+            # a write committed while the view was running, this body may already be stale
+            if versions != table_versions.get(tables):
+                return
+            self._entries[key] = (tables, time.monotonic() + self.ttl, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, tables):
+        # shared entries go stale through the generation bump in versions
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if not tables.isdisjoint(entry[0])]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        if self.shared is not None:
+            self.shared.clear()
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "shared" if self.shared is not None else "memory",
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+response_cache = ResponseCache()
+
+
+@changes.on_change
+def _invalidate(changed):
+    response_cache.invalidate({change.table for change in changed})
+
+
+def cache_key(path, args):
+    return (path, tuple(sorted(args.items(multi=True))))
+
+
+def cached(*models):
+    # models lists every table the view reads, a write to any of them drops the entry
+    tables = tuple(model.__tablename__ for model in models)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not response_cache.enabled:
+                return view(*args, **kwargs)
+
+            key = cache_key(request.path, request.args)
+            body = response_cache.get(key)
+            if body is not None:
+                response = current_app.response_class(body, mimetype="application/json")
+                response.headers["X-Cache"] = "HIT"
+                return response
+
+            versions = table_versions.get(tables)
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not may_be_stale(table_versions.last_modified(tables)):
+                response_cache.set(key, tables, versions, response.get_data())
+            response.headers["X-Cache"] = "MISS"
+            return response
+        return wrapper
+    return decorator
+
+
+def setup_cache(app, *models):
+    response_cache.max_entries = app.config.get("CACHE_MAX_ENTRIES", response_cache.max_entries)
+    response_cache.ttl = app.config.get("CACHE_TTL", response_cache.ttl)
+    response_cache.enabled = app.config.get("CACHE_ENABLED", True)
+    changes.watch(*models)
+    metrics.register("cache", response_cache.stats)
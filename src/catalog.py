@@ -0,0 +1,207 @@
+"""
+Keyset pagination, field projection, filtering and sorting for the catalog list endpoints
+"""
+import sys
+import json
+import base64
+import binascii
+from dataclasses import fields as dataclass_fields
+from sqlalchemy import select, tuple_
+from models import db, People, Planets, Films, Starships, numeric_shadows
+from utils import APIException
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+# Only columns with an index (or a unique constraint) can be filtered on
+FILTERS = {
+    People: ["name", "gender", "homeworld"],
+    Planets: ["name", "climate", "terrain"],
+    Films: ["title", "director", "episode_id"],
+    Starships: ["name", "model", "starship_class", "manufacturer"],
+}
+
+# ?min_<name>= / ?max_<name>= / ?sort=[-]<name> run on the indexed numeric shadow of <name>
+RANGES = {model: numeric_shadows(model) for model in FILTERS}
+
+
+def serializable_fields(model):
+    # the dataclass annotations are what jsonify sends, so projections follow them too
+    return [field.name for field in dataclass_fields(model)]
+
+
+def parse_int_arg(args, name, default=None):
+    value = args.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise APIException(f"'{name}' must be an integer", status_code=400)
+
+
+def projected_columns(model, fields):
+    available = serializable_fields(model)
+    if not fields:
+        return [getattr(model, name) for name in available]
+
+    requested = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in requested if name not in available]
+    if unknown:
+        raise APIException(f"Unknown fields: {', '.join(unknown)}", status_code=400)
+    # the id is always returned because it is the pagination cursor
+    names = ["id"] + [name for name in requested if name != "id"]
+    return [getattr(model, name) for name in names]
+
+
+def filter_clause(model, name, value):
+    column = getattr(model, name)
+    if column.type.python_type is int:
+        try:
+            return column == int(value)
+        except ValueError:
+            raise APIException(f"'{name}' must be an integer", status_code=400)
+
+    if value.endswith("*") and len(value) > 1:
+        # "Tat*" becomes a range scan so the index is used, startswith re-checks it
+        prefix = value[:-1]
+        clause = (column >= prefix) & column.startswith(prefix, autoescape=True)
+        last = ord(prefix[-1])
+        if last == sys.maxunicode:
+            # nothing sorts after it, the lower bound alone still narrows the scan
+            return clause
+        # the surrogates cannot be encoded, the character after U+D7FF is U+E000
+        upper = prefix[:-1] + chr(0xE000 if last == 0xD7FF else last + 1)
+        return clause & (column < upper)
+    return column == value
+
+
+def parse_number_arg(args, name, column):
+    value = args.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        return column.type.python_type(value)
+    except ValueError:
+        raise APIException(f"'{name}' must be a number", status_code=400)
+
+
+def filtered_query(model, args):
+    query = select(*projected_columns(model, args.get("fields")))
+    for name in FILTERS.get(model, []):
+        value = args.get(name)
+        if value is not None:
+            query = query.where(filter_clause(model, name, value))
+    for name, column in RANGES.get(model, {}).items():
+        low = parse_number_arg(args, f"min_{name}", column)
+        if low is not None:
+            query = query.where(column >= low)
+        high = parse_number_arg(args, f"max_{name}", column)
+        if high is not None:
+            query = query.where(column <= high)
+    return query
+
+
+def page_args(args):
+    limit = parse_int_arg(args, "limit", DEFAULT_LIMIT)
+    if limit < 1 or limit > MAX_LIMIT:
+        raise APIException(f"'limit' must be between 1 and {MAX_LIMIT}", status_code=400)
+    return parse_int_arg(args, "after"), limit
+
+
+def list_query(model, args):
+    after, limit = page_args(args)
+
+    # one extra row tells us if there is a next page without a COUNT(*)
+    query = filtered_query(model, args).order_by(model.id).limit(limit + 1)
+    if after is not None:
+        query = query.where(model.id > after)
+    return query, limit
+
+
+def build_page(rows, limit):
+    results = [row._asdict() for row in rows[:limit]]
+    next_cursor = results[-1]["id"] if len(rows) > limit else None
+    return {"results": results, "next": next_cursor}
+
+
+def encode_cursor(value, row_id):
+    return base64.urlsafe_b64encode(json.dumps([value, row_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, binascii.Error):
+        raise APIException("'after' is not a cursor of this sort order", status_code=400)
+    if not isinstance(row_id, int) or not (value is None or isinstance(value, (int, float))):
+        raise APIException("'after' is not a cursor of this sort order", status_code=400)
+    return value, row_id
+
+
+def sort_column(model, args):
+    name = args.get("sort", "")
+    descending = name.startswith("-")
+    column = RANGES.get(model, {}).get(name.lstrip("-"))
+    if column is None:
+        raise APIException(f"'sort' must be one of {', '.join(RANGES[model]) or 'nothing'}, '-' in front for descending",
+                           status_code=400)
+    return column, descending
+
+
+def sorted_queries(model, args):
+    """(values query, nulls query, limit) of a ?sort= page, rows without a value come after all the others
+
+    The two parts are separate queries so each one is an index range scan, either can be None.
+    The cursor in `after` is the (value, id) of the last row, the ids break ties.
+    """
+    column, descending = sort_column(model, args)
+    limit = parse_int_arg(args, "limit", DEFAULT_LIMIT)
+    if limit < 1 or limit > MAX_LIMIT:
+        raise APIException(f"'limit' must be between 1 and {MAX_LIMIT}", status_code=400)
+    after = decode_cursor(args["after"]) if args.get("after") else None
+    base = filtered_query(model, args).add_columns(column.label("sort_value"))
+
+    values = None
+    if after is None or after[0] is not None:
+        values = base.where(column.is_not(None)).limit(limit + 1)
+        if descending:
+            values = values.order_by(column.desc(), model.id.desc())
+        else:
+            values = values.order_by(column, model.id)
+        if after is not None:
+            position = tuple_(column, model.id)
+            values = values.where(position < after if descending else position > after)
+
+    nulls = None
+    name = column.info["shadow_of"]
+    if not args.get(f"min_{name}") and not args.get(f"max_{name}"):
+        nulls = base.where(column.is_(None)).order_by(model.id).limit(limit + 1)
+        if after is not None and after[0] is None:
+            nulls = nulls.where(model.id > after[1])
+    return values, nulls, limit
+
+
+def build_sorted_page(rows, limit):
+    results = []
+    for row in rows[:limit]:
+        result = row._asdict()
+        del result["sort_value"]
+        results.append(result)
+    next_cursor = encode_cursor(rows[limit - 1].sort_value, rows[limit - 1].id) if len(rows) > limit else None
+    return {"results": results, "next": next_cursor}
+
+
+def sorted_page(model, args):
+    values, nulls, limit = sorted_queries(model, args)
+    rows = db.session.execute(values).all() if values is not None else []
+    if nulls is not None and len(rows) <= limit:
+        rows += db.session.execute(nulls.limit(limit + 1 - len(rows))).all()
+    return build_sorted_page(rows, limit)
+
+
+def list_page(model, args):
+    if args.get("sort"):
+        return sorted_page(model, args)
+    query, limit = list_query(model, args)
+    return build_page(db.session.execute(query).all(), limit)
@@ -0,0 +1,59 @@
+"""
+Collects the rows written through the ORM and announces them once the transaction commits
+"""
+from collections import namedtuple
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+# values is a snapshot of the row's columns taken at flush time, None for bulk changes
+Change = namedtuple("Change", ["table", "op", "id", "values"], defaults=(None,))
+
+_listeners = []
+_watched = set()
+
+
+def on_change(listener):
+    # listener(changes) gets a list of Change after every commit that touched a watched model
+    _listeners.append(listener)
+    return listener
+
+
+def notify(changes):
+    if not changes:
+        return
+    for listener in _listeners:
+        listener(changes)
+
+
+def record(session, changes):
+    # bulk statements bypass the mapper events, they record their rows here to be announced on commit
+    session.info.setdefault("pending_changes", []).extend(changes)
+
+
+def _recorder(op):
+    def record_row(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            values = {attr.key: getattr(target, attr.key) for attr in mapper.column_attrs}
+            record(session, [Change(mapper.local_table.name, op, values.get("id"), values)])
+    return record_row
+
+
+def watch(*models):
+    for model in models:
+        if model in _watched:
+            continue
+        _watched.add(model)
+        event.listen(model, "after_insert", _recorder("insert"))
+        event.listen(model, "after_update", _recorder("update"))
+        event.listen(model, "after_delete", _recorder("delete"))
+
+
+@event.listens_for(Session, "after_commit")
+def _announce(session):
+    notify(session.info.pop("pending_changes", None))
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard(session):
+    session.info.pop("pending_changes", None)
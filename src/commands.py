@@ -0,0 +1,161 @@
+"""
+Flask CLI commands, e.g. `flask catalog load planets.json people.ndjson`
+"""
+import os
+import json
+import time
+from itertools import islice
+import click
+from flask.cli import AppGroup
+from models import db, People, Planets, Films, Starships
+from swapi import normalize
+from snapshot import write_snapshot
+import changes
+
+# Planets go first so People.homeworld can be resolved against them
+RESOURCES = {
+    "planets": (Planets, "name"),
+    "films": (Films, "title"),
+    "starships": (Starships, "name"),
+    "people": (People, "name"),
+}
+ALIASES = {"characters": "people", "vehicles": "starships"}
+
+catalog_cli = AppGroup("catalog", help="Catalog data management.")
+
+
+def resource_for(path):
+    stem = os.path.basename(path).split(".")[0].lower()
+    return ALIASES.get(stem, stem)
+
+
+def read_records(path):
+    # NDJSON is read line by line, JSON may be a list or a SWAPI page with "results"
+    with open(path, encoding="utf-8") as file:
+        if path.endswith((".ndjson", ".jsonl")):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        data = json.load(file)
+    if isinstance(data, dict):
+        data = data.get("results", [data])
+    yield from data
+
+
+def homeworld_resolver():
+    # SWAPI people point at their homeworld by URL, the FK is on Planets.name
+    names = {}
+    for planet_id, name, url in db.session.execute(db.select(Planets.id, Planets.name, Planets.url)):
+        names[name] = name
+        names[planet_id] = name
+        if url:
+            names[url.rstrip("/")] = name
+
+    def resolve(value):
+        if isinstance(value, str):
+            value = value.rstrip("/")
+        return names.get(value)
+    return resolve
+
+
+def upsert_statement(model, key):
+    table = model.__table__
+    columns = [column.key for column in table.columns if column.key not in ("id", key)]
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(table)
+        return statement.on_duplicate_key_update({column: statement.inserted[column] for column in columns})
+    else:
+        raise click.ClickException(f"Upserts are not supported on {dialect}")
+    statement = insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=[key], set_={column: statement.excluded[column] for column in columns})
+
+
+def load_file(path, resource, batch_size):
+    model, key = RESOURCES[resource]
+    statement = upsert_statement(model, key)
+    resolve_homeworld = homeworld_resolver() if model is People else None
+    stats = {"rows": 0, "rejected": 0, "defaulted": 0}
+
+    def rows():
+        for record in read_records(path):
+            # Django fixture format used by the SWAPI repository
+            record = record.get("fields", record)
+            row, defaulted = normalize(model, record, key)
+            if row is None:
+                stats["rejected"] += 1
+                continue
+            if resolve_homeworld is not None:
+                row["homeworld"] = resolve_homeworld(record.get("homeworld"))
+            stats["defaulted"] += defaulted
+            yield row
+
+    records = rows()
+    while True:
+        # the same name twice in one batch would make ON CONFLICT hit a row twice
+        batch = list({row[key]: row for row in islice(records, batch_size)}.values())
+        if not batch:
+            break
+        # sent in batches, committed by the caller once every file is in
+        db.session.execute(statement, batch)
+        stats["rows"] += len(batch)
+    return stats
+
+
+@catalog_cli.command("load")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--resource", type=click.Choice(sorted(RESOURCES)), help="Resource of every file, defaults to the file name.")
+@click.option("--batch-size", default=1000, show_default=True)
+def load_catalog(paths, resource, batch_size):
+    """Upsert SWAPI JSON/NDJSON dumps into the catalog tables.
+
+    Running API workers only notice the load through the shared table versions: set SHARED_CACHE_PATH
+    in the environment both the workers and this command read (gunicorn.conf.py otherwise picks a
+    path of its own) or restart the workers afterwards.
+
+    All files load in one transaction: a file that fails to read or to write loads nothing at all.
+    """
+    files = [(path, resource or resource_for(path)) for path in paths]
+    for path, name in files:
+        if name not in RESOURCES:
+            raise click.BadParameter(f"cannot tell the resource of {path}, use --resource", param_hint="paths")
+    order = list(RESOURCES)
+    files.sort(key=lambda item: order.index(item[1]))
+
+    for path, name in files:
+        started = time.perf_counter()
+        try:
+            stats = load_file(path, name, batch_size)
+        except Exception as error:
+            db.session.rollback()
+            raise click.ClickException(f"{path}: {error}, nothing was loaded")
+        elapsed = time.perf_counter() - started
+        click.echo(f"{name}: {stats['rows']} rows from {path} in {elapsed:.2f}s "
+                   f"({stats['rows'] / elapsed if elapsed else 0:.0f} rows/s), "
+                   f"{stats['rejected']} rejected, {stats['defaulted']} unknown values set to 0")
+    db.session.commit()
+    # bulk upserts bypass the ORM events, so the caches of this process and, through SHARED_CACHE_PATH,
+    # the table versions the workers check are told explicitly
+    changes.notify([changes.Change(RESOURCES[name][0].__tablename__, "load", None) for name in dict.fromkeys(name for _, name in files)])
+
+
+@catalog_cli.command("snapshot")
+@click.option("--output", default=lambda: os.getenv("CATALOG_SNAPSHOT_PATH", "catalog.snapshot"),
+              show_default="$CATALOG_SNAPSHOT_PATH or catalog.snapshot", type=click.Path(dir_okay=False))
+def snapshot_catalog(output):
+    """Write the catalog tables to the snapshot file the API serves reads from."""
+    started = time.perf_counter()
+    toc = write_snapshot(output)
+    rows = ", ".join(f"{table['count']} {name}" for name, table in toc["tables"].items())
+    click.echo(f"{output}: {rows}, {os.path.getsize(output)} bytes in {time.perf_counter() - started:.2f}s")
+
+
+def setup_commands(app):
+    app.cli.add_command(catalog_cli)
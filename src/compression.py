@@ -0,0 +1,197 @@
+"""
+Negotiated gzip / brotli / zstd compression of JSON responses
+
+Catalog responses carry a version ETag (see versions.conditional), their compressed bodies are kept per
+ETag and encoding, so each one is compressed once per data version and reused until the tables change.
+brotli and zstandard are optional, without them only gzip is offered.
+"""
+import os
+import gzip
+import time
+import threading
+from collections import OrderedDict
+from flask import request, g
+from werkzeug.http import parse_accept_header
+import changes
+import metrics
+from versions import compute_etag
+from instrumentation import add_timing
+
+CODECS = {"gzip": lambda body, level: gzip.compress(body, compresslevel=level, mtime=0)}
+DEFAULT_LEVELS = {"gzip": 6, "br": 5, "zstd": 3}
+
+try:
+    import brotli
+    CODECS["br"] = lambda body, level: brotli.compress(body, quality=level)
+except ImportError:
+    pass
+
+try:
+    import zstandard
+    CODECS["zstd"] = lambda body, level: zstandard.ZstdCompressor(level=level).compress(body)
+except ImportError:
+    pass
+
+COMPRESSIBLE = {"application/json", "application/x-ndjson", "text/plain", "text/html"}
+
+
+def parse_levels(value):
+    # "gzip:6,br:5,zstd:3"
+    levels = dict(DEFAULT_LEVELS)
+    for part in filter(None, (value or "").split(",")):
+        name, _, level = part.partition(":")
+        levels[name.strip()] = int(level)
+    return levels
+
+
+def variant_etag(etag, encoding):
+    # versions.is_not_modified strips the suffix again when the client revalidates
+    return f"{etag}-{encoding}"
+
+
+class Compressor:
+    def __init__(self):
+        self.encodings = [name for name in ("zstd", "br", "gzip") if name in CODECS]
+        self.levels = dict(DEFAULT_LEVELS)
+        self.min_size = 1024
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def configure(self, encodings, levels, min_size):
+        unknown = [name for name in encodings if name not in CODECS]
+        if unknown:
+            raise ValueError(f"COMPRESS_ENCODINGS: {', '.join(unknown)} not available, install brotli / zstandard")
+        self.encodings = encodings
+        self.levels = levels
+        self.min_size = min_size
+
+    def negotiate(self, accept_encoding):
+        # the client's highest q wins, ties go to the order of COMPRESS_ENCODINGS
+        accepted = parse_accept_header(accept_encoding)
+        best, best_quality = None, 0
+        for name in self.encodings:
+            quality = accepted.quality(name)
+            if quality > best_quality:
+                best, best_quality = name, quality
+        return best
+
+    def compress(self, encoding, body):
+        started = time.perf_counter()
+        compressed = CODECS[encoding](body, self.levels[encoding])
+        seconds = time.perf_counter() - started
+        add_timing("compress", seconds)
+        with self._lock:
+            total = self._totals.setdefault(encoding, {"count": 0, "bytes_in": 0, "bytes_out": 0, "seconds": 0.0})
+            total["count"] += 1
+            total["bytes_in"] += len(body)
+            total["bytes_out"] += len(compressed)
+            total["seconds"] += seconds
+        return compressed
+
+    def stats(self):
+        with self._lock:
+            return {"encodings": self.encodings, "min_size": self.min_size, "levels": self.levels,
+                    "compressed": {name: dict(total, seconds=round(total["seconds"], 3))
+                                   for name, total in self._totals.items()}}
+
+
+class CompressedVariants:
+    # (etag, encoding) -> compressed body, LRU bounded, dropped when one of its tables changes
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, etag, encoding):
+        with self._lock:
+            entry = self._entries.get((etag, encoding))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((etag, encoding))
+            self.hits += 1
+            return entry[1]
+
+    def set(self, etag, encoding, tables, body):
+        with self._lock:
+            self._entries[(etag, encoding)] = (tables, body)
+            self._entries.move_to_end((etag, encoding))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tables):
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if not tables.isdisjoint(entry[0])]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits,
+                    "misses": self.misses, "invalidations": self.invalidations}
+
+
+compressor = Compressor()
+compressed_variants = CompressedVariants()
+
+
+@changes.on_change
+def _invalidate(changed):
+    compressed_variants.invalidate({change.table for change in changed})
+
+
+def compressed_body(encoding, body, etag=None, tables=()):
+    # without a version ETag the body is compressed for this response only
+    if etag is None or compressed_variants.max_entries <= 0:
+        return compressor.compress(encoding, body)
+    compressed = compressed_variants.get(etag, encoding)
+    if compressed is None:
+        compressed = compressor.compress(encoding, body)
+        compressed_variants.set(etag, encoding, tables, compressed)
+    return compressed
+
+
+def compressible(response):
+    return (not response.is_streamed and not response.direct_passthrough
+            and "Content-Encoding" not in response.headers and response.mimetype in COMPRESSIBLE)
+
+
+def setup_compression(app):
+    encodings = os.getenv("COMPRESS_ENCODINGS")
+    compressor.configure([name.strip() for name in encodings.split(",") if name.strip()] if encodings is not None
+                         else compressor.encodings,
+                         parse_levels(os.getenv("COMPRESS_LEVELS")), int(os.getenv("COMPRESS_MIN_SIZE", 1024)))
+    compressed_variants.max_entries = int(os.getenv("COMPRESS_CACHE_ENTRIES", 1024))
+    if not compressor.encodings:
+        return
+    metrics.register("compression", lambda: dict(compressor.stats(), variants=compressed_variants.stats()))
+
+    @app.after_request
+    def compress_response(response):
+        if not compressible(response):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = compressor.negotiate(request.headers.get("Accept-Encoding"))
+        if encoding is None:
+            return response
+        etag, _ = response.get_etag()
+        if response.status_code == 304:
+            # answer with the tag the client holds for this encoding
+            if etag and request.if_none_match.contains(variant_etag(etag, encoding)):
+                response.set_etag(variant_etag(etag, encoding))
+            return response
+        if response.status_code != 200 or response.calculate_content_length() < compressor.min_size:
+            return response
+        tables = g.get("conditional_tables")
+        if not tables or compute_etag(tables, request.full_path) != etag:
+            # not a catalog response, or a write committed while the view ran: nothing to reuse
+            tables = None
+        response.set_data(compressed_body(encoding, response.get_data(), etag if tables else None, tables))
+        response.headers["Content-Encoding"] = encoding
+        if etag:
+            response.set_etag(variant_etag(etag, encoding))
+        return response
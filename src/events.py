@@ -0,0 +1,311 @@
+"""
+Server-Sent Events feed of committed catalog and favorites changes on GET /events
+
+    GET /events?types=characters,planets        catalog changes of those resources
+    GET /events?favorites=1                     the caller's favorites and changes to the rows they point at
+
+Every commit announced by the changes module becomes one event per row, numbered in commit order.
+The broker fans them out to the open streams, each with its own bounded buffer; a client that falls
+that far behind gets a `reset` event and is disconnected, and a reconnect with Last-Event-ID replays
+what it missed from the last EVENTS_HISTORY events (or gets a `reset` when that is too old).
+A favorites event only ever goes to the user it belongs to.
+
+Event ids are "<epoch>-<n>": the in-process backend starts a new epoch with every worker process, so
+a client that resumes against another worker (or a restarted one) gets a `reset` rather than a
+wrong replay. It also only sees this worker's commits. With EVENTS_URL (a Redis pub/sub) every
+worker publishes to and listens on one channel, and the epoch and the counter are shared.
+
+Under gunicorn every stream holds a worker thread: gunicorn.conf.py runs gthread workers and keeps
+EVENTS_MAX_SUBSCRIBERS below their thread count, on a sync worker /events answers 503. The ASGI app
+(asgi.py) serves a stream as a coroutine waiting on its queue, with no thread of its own, so many
+more can stay open. A stream over EVENTS_MAX_SUBSCRIBERS gets a 503 with Retry-After in both.
+"""
+import os
+import json
+import queue
+import threading
+from collections import deque, namedtuple
+from flask import request, current_app
+from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
+import changes
+import metrics
+from models import Favorites, People, Planets, Films, Starships
+from favorites_cache import favorites_cache
+from serializer import dumps
+from utils import APIException
+
+RESOURCES = {"People": "characters", "Planets": "planets", "Films": "films", "Starships": "starships",
+             "Favorites": "favorites"}
+TABLES = {resource: table for table, resource in RESOURCES.items()}
+RESET = b"event: reset\ndata: {}\n\n"
+KEEPALIVE = b": keepalive\n\n"
+RETRY_SECONDS = 3
+
+# data is the encoded SSE message, written once and sent to every subscriber as is
+Event = namedtuple("Event", ["id", "payload", "data"])
+# nginx would otherwise buffer the stream
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def make_event(epoch, event_id, payload):
+    return Event(event_id, payload, b"id: %s-%d\nevent: change\ndata: %s\n\n" % (epoch.encode(), event_id, dumps(payload)))
+
+
+def change_payload(change):
+    payload = {"type": RESOURCES[change.table], "op": change.op, "id": change.id}
+    if change.table == Favorites.__tablename__ and change.values is not None:
+        favorite = {name: change.values.get(name) for name in ("id", "external_id", "name", "type")}
+        # the enum as its value, the user id as an int whatever form the writer used
+        favorite["type"] = getattr(favorite["type"], "value", favorite["type"])
+        payload.update(user_id=int(change.values["user_id"]), favorite=favorite)
+    return payload
+
+
+class Subscriber:
+    def __init__(self, types, user_id, favorites, buffer_size):
+        self.queue = queue.Queue(buffer_size)
+        self.types = types
+        self.user_id = user_id
+        # {(table, row id)} of the user's favorites when the stream is filtered by them, else None
+        self.favorites = favorites
+        self.overflowed = False
+
+    def wants(self, payload):
+        if payload["type"] == "favorites":
+            if payload.get("user_id") is None or payload["user_id"] != self.user_id:
+                return False
+            if self.favorites is not None:
+                key = (payload["favorite"]["type"], payload["favorite"]["external_id"])
+                if payload["op"] == "delete":
+                    self.favorites.discard(key)
+                else:
+                    self.favorites.add(key)
+            return self.types is None or "favorites" in self.types
+        if self.types is not None and payload["type"] not in self.types:
+            return False
+        if self.favorites is not None and payload["id"] is not None:
+            return (TABLES[payload["type"]], payload["id"]) in self.favorites
+        return True
+
+    def offer(self, data):
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            self.overflowed = True
+
+
+class LocalBackend:
+    # this process only: ids from a counter, delivered as soon as they are published
+    def __init__(self):
+        self.broker = None
+        self.epoch = os.urandom(4).hex()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def start(self, broker):
+        self.broker = broker
+
+    def publish(self, payloads):
+        with self._lock:
+            events = [make_event(self.epoch, self._next_id + offset, payload) for offset, payload in enumerate(payloads)]
+            self._next_id += len(payloads)
+            self.broker.deliver(events)
+
+
+class RedisBackend:
+    # every worker publishes to one channel and numbers its events from one INCRBY counter
+    def __init__(self, client, channel="events"):
+        self.client = client
+        self.channel = channel
+        self.broker = None
+        self.epoch = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self, broker):
+        self.broker = broker
+
+    def listen(self):
+        # a listener thread started before gunicorn forked would not exist in the worker
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # the first worker to get here picks the epoch, the counter it numbers is as old as it
+            self.client.set(f"{self.channel}:epoch", os.urandom(4).hex(), nx=True)
+            self.epoch = self.client.get(f"{self.channel}:epoch").decode()
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self.channel)
+            threading.Thread(target=self._receive, args=(pubsub,), daemon=True, name="events-listener").start()
+
+    def _receive(self, pubsub):
+        for message in pubsub.listen():
+            self.broker.deliver([make_event(self.epoch, event_id, payload)
+                                 for event_id, payload in json.loads(message["data"])])
+
+    def publish(self, payloads):
+        self.listen()
+        last = self.client.incrby(f"{self.channel}:id", len(payloads))
+        first = last - len(payloads) + 1
+        self.client.publish(self.channel, b"[" + b",".join(
+            b"[%d,%s]" % (first + offset, dumps(payload)) for offset, payload in enumerate(payloads)) + b"]")
+
+
+class TooManySubscribers(APIException):
+    status_code = 503
+    # the same delay the stream asks EventSource to reconnect after
+    retry_after = RETRY_SECONDS
+
+
+class EventBroker:
+    def __init__(self, backend=None, history=1000, buffer_size=100, max_subscribers=100):
+        self.history = deque(maxlen=history)
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self.published = 0
+        self.overflows = 0
+        self.use(backend or LocalBackend())
+
+    def use(self, backend):
+        self.backend = backend
+        backend.start(self)
+
+    def publish(self, payloads):
+        if payloads:
+            self.published += len(payloads)
+            self.backend.publish(payloads)
+
+    def deliver(self, events):
+        with self._lock:
+            for event in events:
+                self.history.append(event)
+                for subscriber in self._subscribers:
+                    if not subscriber.overflowed and subscriber.wants(event.payload):
+                        subscriber.offer(event.data)
+                        self.overflows += subscriber.overflowed
+
+    def subscribe(self, subscriber, last_event_id=None):
+        """Registers subscriber, returns the messages it missed since last_event_id, an (epoch, n) pair"""
+        if isinstance(self.backend, RedisBackend):
+            self.backend.listen()
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise TooManySubscribers("Too many open event streams, retry later")
+            self._subscribers.add(subscriber)
+            if last_event_id is None:
+                return []
+            epoch, last_event_id = last_event_id
+            if epoch != self.backend.epoch:
+                # numbered by another process or before a restart, nothing here lines up with it
+                return [RESET]
+            if not self.history or last_event_id < self.history[0].id - 1:
+                # nothing to resume from, the client starts over from a fresh list
+                return [RESET] if last_event_id < (self.history[-1].id if self.history else 0) else []
+            return [event.data for event in self.history if event.id > last_event_id and subscriber.wants(event.payload)]
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def stats(self):
+        with self._lock:
+            return {"backend": type(self.backend).__name__, "subscribers": len(self._subscribers),
+                    "history": len(self.history), "last_id": self.history[-1].id if self.history else None,
+                    "published": self.published, "overflows": self.overflows}
+
+
+event_broker = EventBroker()
+
+
+@changes.on_change
+def _publish(changed):
+    event_broker.publish([change_payload(change) for change in changed if change.table in RESOURCES])
+
+
+def parse_last_event_id(value):
+    if not value:
+        return None
+    epoch, _, number = value.rpartition("-")
+    try:
+        return epoch, int(number)
+    except ValueError:
+        raise APIException("'Last-Event-ID' must be an id sent by this stream", status_code=400)
+
+
+def last_event_id():
+    # EventSource sends the header on reconnects, the query argument lets a fresh page resume
+    return parse_last_event_id(request.headers.get("Last-Event-ID") or request.args.get("last_event_id"))
+
+
+def stream_types(args):
+    types = {name for name in args.get("types", "").split(",") if name} or None
+    if types and not types.issubset(RESOURCES.values()):
+        raise APIException(f"'types' must be among {', '.join(RESOURCES.values())}", status_code=400)
+    return types
+
+
+def wants_favorites(args, user_id):
+    if args.get("favorites") not in ("1", "true"):
+        return False
+    if user_id is None:
+        raise APIException("'favorites' needs a logged in user", status_code=401)
+    return True
+
+
+def favorite_keys(rows):
+    return {(getattr(row["type"], "value", row["type"]), row["external_id"]) for row in rows}
+
+
+def event_stream(heartbeat):
+    if request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn") and not request.environ.get("wsgi.multithread"):
+        # a stream would hold the whole worker and be killed by its timeout
+        raise APIException("Event streams need a threaded worker (gunicorn --worker-class gthread)", status_code=503)
+    types = stream_types(request.args)
+    verify_jwt_in_request(optional=True)
+    identity = get_jwt_identity()
+    user_id = int(identity) if identity is not None else None
+    favorites = None
+    if wants_favorites(request.args, user_id):
+        favorites = favorite_keys(favorites_cache.get(user_id, lambda: Favorites.query.filter_by(user_id=user_id).all()))
+
+    subscriber = Subscriber(types, user_id, favorites, event_broker.buffer_size)
+    missed = event_broker.subscribe(subscriber, last_event_id())
+
+    def generate():
+        try:
+            yield b"retry: %d\n\n" % (RETRY_SECONDS * 1000)
+            yield from missed
+            while True:
+                try:
+                    yield subscriber.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    if subscriber.overflowed:
+                        # everything buffered was sent, the client reconnects and resumes from the history
+                        yield RESET
+                        return
+                    yield KEEPALIVE
+                    continue
+                if subscriber.overflowed and subscriber.queue.empty():
+                    yield RESET
+                    return
+        finally:
+            event_broker.unsubscribe(subscriber)
+
+    response = current_app.response_class(generate(), mimetype="text/event-stream")
+    response.headers.update(STREAM_HEADERS)
+    return response
+
+
+def setup_events(app):
+    app.config["EVENTS_HEARTBEAT"] = float(os.getenv("EVENTS_HEARTBEAT", 15))
+    event_broker.history = deque(maxlen=int(os.getenv("EVENTS_HISTORY", 1000)))
+    event_broker.buffer_size = int(os.getenv("EVENTS_BUFFER", 100))
+    event_broker.max_subscribers = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", 100))
+    url = os.getenv("EVENTS_URL")
+    if url:
+        import redis
+        event_broker.use(RedisBackend(redis.Redis.from_url(url)))
+    changes.watch(People, Planets, Films, Starships, Favorites)
+    metrics.register("events", event_broker.stats)
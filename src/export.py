@@ -0,0 +1,52 @@
+"""
+Streams whole catalog tables as NDJSON with server-side cursors, optionally gzipped on the fly
+"""
+import zlib
+from flask import request, current_app, stream_with_context
+from models import db
+from catalog import filtered_query
+from serializer import dumps
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+CHUNK_SIZE = 1000
+
+
+def wants_ndjson():
+    # */* and plain JSON clients keep getting the paginated JSON
+    return request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def ndjson_chunks(query, chunk_size=CHUNK_SIZE):
+    # yield_per keeps one partition of rows in memory, stream_results asks the driver for a server-side cursor
+    result = db.session.execute(query.execution_options(yield_per=chunk_size, stream_results=True))
+    for partition in result.partitions():
+        yield b"".join(dumps(row._asdict()) + b"\n" for row in partition)
+
+
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_response(model):
+    # fields= and the indexed filters work here too, but there is no limit.
+    # the query is built up front so bad arguments still get a 400 before streaming starts
+    query = filtered_query(model, request.args).order_by(model.id)
+    use_gzip = "gzip" in request.accept_encodings
+
+    @stream_with_context
+    def generate():
+        chunks = ndjson_chunks(query)
+        if use_gzip:
+            chunks = gzip_chunks(chunks)
+        yield from chunks
+
+    response = current_app.response_class(generate(), mimetype=NDJSON_MIMETYPE)
+    if use_gzip:
+        response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
@@ -0,0 +1,151 @@
+"""
+Adds and removes many favorites in one request: one IN query per target type, one bulk statement and one commit
+"""
+from sqlalchemy import tuple_, or_
+from sqlalchemy.exc import IntegrityError
+import changes
+from changes import Change
+from models import db, Favorites, FavoriteTypeEnum
+from expand import FAVORITE_TARGETS
+from serializer import encoder_for
+from utils import APIException
+
+MAX_BATCH = 100
+
+
+def row_values(favorite):
+    return {column.key: getattr(favorite, column.key) for column in Favorites.__mapper__.column_attrs}
+
+
+def batch_items(data):
+    if not isinstance(data, list) or not data:
+        raise APIException("Expected a non-empty JSON array", status_code=400)
+    if len(data) > MAX_BATCH:
+        raise APIException(f"At most {MAX_BATCH} items per batch", status_code=400)
+    return data
+
+
+def parse_target(item):
+    # returns (FavoriteTypeEnum, external_id) or an error message
+    if not isinstance(item, dict):
+        return "Expected an object"
+    if item.get("type") not in FavoriteTypeEnum.__members__:
+        return "Invalid favorite type"
+    external_id = item.get("external_id")
+    if not isinstance(external_id, int) or isinstance(external_id, bool):
+        return "'external_id' must be an integer"
+    return FavoriteTypeEnum[item["type"]], external_id
+
+
+def target_names(keys):
+    # one IN query per type, the favorite takes the target's name (or title for films)
+    ids_by_type = {}
+    for favorite_type, external_id in keys:
+        ids_by_type.setdefault(favorite_type, set()).add(external_id)
+    names = {}
+    for favorite_type, ids in ids_by_type.items():
+        model = FAVORITE_TARGETS[favorite_type]
+        label = model.title if hasattr(model, "title") else model.name
+        for target_id, name in db.session.execute(db.select(model.id, label).where(model.id.in_(ids))):
+            names[(favorite_type, target_id)] = name
+    return names
+
+
+def existing_favorites(user_id, keys):
+    if not keys:
+        return {}
+    query = db.select(Favorites).where(Favorites.user_id == user_id,
+                                       tuple_(Favorites.type, Favorites.external_id).in_(list(keys)))
+    return {(favorite.type, favorite.external_id): favorite for favorite in db.session.execute(query).scalars()}
+
+
+def add_favorites(user_id, data, retry=True):
+    items = batch_items(data)
+    parsed = [parse_target(item) for item in items]
+    keys = {key for key in parsed if isinstance(key, tuple)}
+    names = target_names(keys)
+    existing = existing_favorites(user_id, keys)
+
+    results, created = [], {}
+    for index, key in enumerate(parsed):
+        if not isinstance(key, tuple):
+            results.append({"index": index, "status": 400, "error": key})
+        elif key in existing:
+            results.append({"index": index, "status": 200, "favorite": existing[key]})
+        elif key not in names:
+            results.append({"index": index, "status": 404, "error": "Target not found"})
+        else:
+            # the same target twice in one batch is created once
+            created.setdefault(key, {"user_id": user_id, "type": key[0], "external_id": key[1], "name": names[key]})
+            results.append({"index": index, "status": 201, "key": key})
+
+    if created:
+        # one multi-row INSERT on every backend, the new ids come back with a single SELECT
+        try:
+            db.session.execute(db.insert(Favorites).values(list(created.values())))
+        except IntegrityError:
+            db.session.rollback()
+            if not retry:
+                raise
+            # a concurrent request added some of them first, nothing from this batch was written
+            return add_favorites(user_id, data, retry=False)
+        inserted = existing_favorites(user_id, created)
+        changes.record(db.session, [Change(Favorites.__tablename__, "insert", favorite.id, row_values(favorite))
+                                    for favorite in inserted.values()])
+        for result in results:
+            if "key" in result:
+                result["favorite"] = inserted[result.pop("key")]
+
+    # serialized before the commit expires them, otherwise each one would be reloaded
+    encode = encoder_for(Favorites)
+    for result in results:
+        if "favorite" in result:
+            result["favorite"] = encode(result["favorite"])
+    db.session.commit()
+    return results
+
+
+def remove_favorites(user_id, data):
+    # items are {"id": ...} or {"type": ..., "external_id": ...}
+    items = batch_items(data)
+    parsed = []
+    for item in items:
+        if isinstance(item, dict) and "id" in item:
+            favorite_id = item["id"]
+            valid = isinstance(favorite_id, int) and not isinstance(favorite_id, bool)
+            parsed.append(favorite_id if valid else "'id' must be an integer")
+        else:
+            parsed.append(parse_target(item))
+
+    ids = {key for key in parsed if isinstance(key, int)}
+    keys = {key for key in parsed if isinstance(key, tuple)}
+    conditions = []
+    if ids:
+        conditions.append(Favorites.id.in_(ids))
+    if keys:
+        conditions.append(tuple_(Favorites.type, Favorites.external_id).in_(list(keys)))
+    found_by_id, found_by_key = {}, {}
+    if conditions:
+        query = db.select(Favorites).where(Favorites.user_id == user_id, or_(*conditions))
+        for favorite in db.session.execute(query).scalars():
+            found_by_id[favorite.id] = favorite
+            found_by_key[(favorite.type, favorite.external_id)] = favorite
+
+    results, deleted = [], {}
+    for index, key in enumerate(parsed):
+        if isinstance(key, str):
+            results.append({"index": index, "status": 400, "error": key})
+            continue
+        favorite = found_by_id.get(key) if isinstance(key, int) else found_by_key.get(key)
+        if favorite is None:
+            results.append({"index": index, "status": 404, "error": "Favorite not found"})
+        else:
+            deleted[favorite.id] = favorite
+            results.append({"index": index, "status": 200, "id": favorite.id})
+
+    if deleted:
+        db.session.execute(db.delete(Favorites).where(Favorites.id.in_(list(deleted))), execution_options={"synchronize_session": False})
+        changes.record(db.session, [Change(Favorites.__tablename__, "delete", favorite.id, row_values(favorite))
+                                    for favorite in deleted.values()])
+        db.session.commit()
+    return results
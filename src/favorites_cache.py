@@ -0,0 +1,267 @@
+"""
+Per-user cache of GET /favorites, kept up to date write-through from the committed favorites changes
+
+The default backend is an in-process LRU, RedisBackend takes any client with the redis-py interface
+(redis.Redis, fakeredis.FakeRedis) so the workers share one copy.
+
+Only this process's commits are written through to the in-process LRU. A favorites write in another
+worker moves the table version (shared between gunicorn workers, see versions) past the one the LRU
+follows and every list in it is dropped, with several workers and frequent writes Redis keeps more.
+In Redis a commit deletes the user's list rather than patching it, two workers patching one key
+would lose a write.
+Every commit also bumps a generation, shared in Redis, a fill that read an older one is not stored.
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+import changes
+import metrics
+from models import Favorites
+from versions import table_versions
+from serializer import dumps, encoder_for
+from catalog import serializable_fields
+
+
+class MemoryBackend:
+    shared = False
+
+    def __init__(self, max_users=10000, ttl=300):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires, favorites = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return favorites
+
+    def set(self, user_id, favorites):
+        with self._lock:
+            self._set(user_id, favorites)
+
+    def _set(self, user_id, favorites):
+        self._entries[user_id] = (time.monotonic() + self.ttl, favorites)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def set_if(self, user_id, favorites, generation):
+        # stores only when no commit happened since generation was read
+        with self._lock:
+            if generation == self.generation:
+                self._set(user_id, favorites)
+
+    def current_generation(self):
+        return self.generation
+
+    def bump(self):
+        with self._lock:
+            self.generation += 1
+
+    def delete(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "memory", "users": len(self._entries), "max_users": self.max_users,
+                    "evictions": self.evictions}
+
+
+class RedisBackend:
+    # entries are JSON strings with a TTL, a sorted set of last-use times keeps the LRU bound across workers
+    shared = True
+
+    def __init__(self, client, max_users=10000, ttl=300, prefix="favorites:"):
+        self.client = client
+        self.max_users = max_users
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lru_key = prefix + "lru"
+        self.generation_key = prefix + "generation"
+
+    def get(self, user_id):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(f"{self.prefix}{user_id}")
+        pipe.zadd(self.lru_key, {str(user_id): time.time()}, xx=True)
+        value = pipe.execute()[0]
+        return json.loads(value) if value is not None else None
+
+    def set(self, user_id, favorites):
+        pipe = self.client.pipeline(transaction=False)
+        self._set(pipe, user_id, favorites)
+        self._evict(pipe.execute()[-1])
+
+    def _set(self, pipe, user_id, favorites):
+        pipe.set(f"{self.prefix}{user_id}", dumps(favorites), ex=self.ttl)
+        pipe.zadd(self.lru_key, {str(user_id): time.time()})
+        pipe.zcard(self.lru_key)
+
+    def set_if(self, user_id, favorites, generation):
+        # WATCH makes the check and the write one step, a commit in any worker in between aborts it
+        from redis.exceptions import WatchError
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.generation_key)
+                if int(pipe.get(self.generation_key) or 0) != generation:
+                    return
+                pipe.multi()
+                self._set(pipe, user_id, favorites)
+                size = pipe.execute()[-1]
+            except WatchError:
+                return
+        self._evict(size)
+
+    def _evict(self, size):
+        if size > self.max_users:
+            evicted = [member.decode() if isinstance(member, bytes) else member
+                       for member, _ in self.client.zpopmin(self.lru_key, size - self.max_users)]
+            self.client.delete(*(f"{self.prefix}{user_id}" for user_id in evicted))
+
+    def current_generation(self):
+        return int(self.client.get(self.generation_key) or 0)
+
+    def bump(self):
+        self.client.incr(self.generation_key)
+
+    def delete(self, user_id):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.delete(f"{self.prefix}{user_id}")
+        pipe.zrem(self.lru_key, str(user_id))
+        pipe.execute()
+
+    def stats(self):
+        return {"backend": "redis", "users": self.client.zcard(self.lru_key), "max_users": self.max_users}
+
+
+class FavoritesCache:
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        # the Favorites table version an unshared backend is in step with, followed by this process's commits
+        self._version = None
+        self.resets = 0
+        self._lock = threading.Lock()
+
+    def sync(self):
+        # a version this process did not produce means a favorites write elsewhere, the local lists may be stale
+        if self.backend.shared:
+            return
+        version = table_versions.get((Favorites.__tablename__,))[0]
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    if self._version is not None:
+                        self.backend.clear()
+                        self.resets += 1
+                    self._version = version
+
+    def lookup(self, user_id):
+        favorites = None
+        if self.enabled:
+            self.sync()
+            favorites = self.backend.get(user_id)
+        if favorites is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return favorites
+
+    def generation(self):
+        # read before the query, a commit after it keeps the fill from being stored
+        return self.backend.current_generation()
+
+    def store(self, user_id, rows, generation):
+        # returns the encoded favorites
+        encode = encoder_for(Favorites)
+        favorites = sorted((encode(row) for row in rows), key=lambda favorite: favorite["id"])
+        if self.enabled:
+            self.backend.set_if(user_id, favorites, generation)
+        return favorites
+
+    def get(self, user_id, load):
+        # load() returns the user's Favorites rows from the database on a miss
+        favorites = self.lookup(user_id)
+        if favorites is None:
+            generation = self.generation()
+            favorites = self.store(user_id, load(), generation)
+        return favorites
+
+    def apply(self, changed):
+        # write-through: patch the cached lists of the users whose favorites were just committed,
+        # or drop them from a shared backend
+        if Favorites.__tablename__ not in {change.table for change in changed}:
+            return
+        by_user = {}
+        for change in changed:
+            if change.table == Favorites.__tablename__ and change.values is not None:
+                # ORM writes from the views carry the identity as the string the JWT holds
+                by_user.setdefault(int(change.values["user_id"]), []).append(change)
+        # before patching, so a fill that read the old generation can no longer be stored
+        self.backend.bump()
+        with self._lock:
+            if self._version is not None:
+                # every commit bumps the table version once
+                self._version += 1
+            for user_id, user_changes in by_user.items():
+                if self.backend.shared:
+                    # another worker may be patching the same key, read-patch-set would lose one of
+                    # the writes: the next read refills it, and the bumped generation keeps a fill
+                    # that started before this commit from being stored
+                    self.backend.delete(user_id)
+                    continue
+                favorites = self.backend.get(user_id)
+                if favorites is None:
+                    continue
+                by_id = {favorite["id"]: favorite for favorite in favorites}
+                for change in user_changes:
+                    if change.op == "delete":
+                        by_id.pop(change.id, None)
+                    else:
+                        favorite = {name: change.values[name] for name in serializable_fields(Favorites)}
+                        by_id[change.id] = {**favorite, "user_id": user_id}
+                self.backend.set(user_id, sorted(by_id.values(), key=lambda favorite: favorite["id"]))
+
+    def stats(self):
+        return {**self.backend.stats(), "hits": self.hits, "misses": self.misses, "resets": self.resets}
+
+
+favorites_cache = FavoritesCache()
+
+
+@changes.on_change
+def _write_through(changed):
+    favorites_cache.apply(changed)
+
+
+def setup_favorites_cache(app):
+    max_users = int(os.getenv("FAVORITES_CACHE_MAX_USERS", 10000))
+    ttl = int(os.getenv("FAVORITES_CACHE_TTL", 300))
+    url = os.getenv("FAVORITES_CACHE_URL")
+    if url:
+        import redis
+        favorites_cache.backend = RedisBackend(redis.Redis.from_url(url), max_users, ttl)
+    else:
+        favorites_cache.backend = MemoryBackend(max_users, ttl)
+    favorites_cache.enabled = app.config.get("CACHE_ENABLED", True)
+    changes.watch(Favorites)
+    metrics.register("favorites_cache", favorites_cache.stats)
@@ -0,0 +1,49 @@
+# Picked up by `gunicorn wsgi --chdir ./src/` (see Procfile), settings can be overridden with GUNICORN_CMD_ARGS
+# With --preload the app is created once in the master and the workers share its memory copy-on-write
+import gc
+import os
+import sys
+import hashlib
+import tempfile
+
+# workers only agree on table versions (so on ETags and Last-Modified) through the shared segment, it is on
+# by default under gunicorn, one file per database. SHARED_CACHE_PATH= (empty) turns it off
+os.environ.setdefault("SHARED_CACHE_PATH", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+    "starwars-api-" + hashlib.sha1(os.getenv("DATABASE_URL", "").encode("utf-8")).hexdigest()[:12]))
+
+# a request thread per connection: an /events stream then holds one thread instead of a whole worker,
+# and the worker's heartbeat does not wait for it, so long streams are not killed by the timeout
+worker_class = "gthread"
+# WEB_CONCURRENCY is what Heroku and Render size to the instance, gunicorn's own default is 1
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+# streams may take at most half of a worker's threads, the others keep serving requests: the host takes
+# workers * EVENTS_MAX_SUBSCRIBERS streams (8 by default), then answers 503 with Retry-After.
+# uvicorn asgi:application serves a stream as a coroutine instead and is limited by the file descriptors
+os.environ.setdefault("EVENTS_MAX_SUBSCRIBERS", str(max(threads // 2, 1)))
+
+
+def on_starting(server):
+    # a cache file left by the previous deployment could predate writes made while nothing was running,
+    # it is reset in place: with --preload the master has already mapped it
+    path = os.getenv("SHARED_CACHE_PATH")
+    if path:
+        from shared_cache import reset_segment
+        reset_segment(path)
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        # objects that survive the import are never collected, freezing them keeps the
+        # collector from writing to (and so copying) the pages the workers share
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    # only matters with --preload, otherwise the app is created after the fork
+    wsgi = sys.modules.get("wsgi")
+    if wsgi is not None:
+        from models import db
+        from pool import dispose_after_fork
+        dispose_after_fork(wsgi.application, db)
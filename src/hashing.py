@@ -0,0 +1,127 @@
+"""
+Runs bcrypt on a small bounded thread pool so login storms cannot take every request thread
+
+The pool and HASH_MAX_PENDING are per process. They only push back when one process runs several
+requests at once (gunicorn gthread/gevent workers, the ASGI entry point): a sync worker serves one
+request at a time, so its queue never fills and a storm still ties it up for the full hash.
+"""
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import jsonify
+from utils import APIException
+import metrics
+
+# milliseconds
+LATENCY_BUCKETS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+class HasherBusy(APIException):
+    status_code = 503
+
+
+class PasswordHasher:
+    def __init__(self, rounds=12, workers=2, max_pending=8, timeout=10):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.queue_wait_ms = metrics.Histogram(LATENCY_BUCKETS)
+        self.hash_ms = metrics.Histogram(LATENCY_BUCKETS)
+        self.rejected = 0
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+
+    def configure(self, rounds, workers, max_pending, timeout):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _pool(self):
+        # created on first use, so a preloading gunicorn master never forks live threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="bcrypt")
+            return self._executor
+
+    def _run(self, fn, *args):
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusy("Too many logins in progress, try again shortly")
+        queued = time.perf_counter()
+
+        def task():
+            started = time.perf_counter()
+            self.queue_wait_ms.observe((started - queued) * 1000)
+            try:
+                return fn(*args)
+            finally:
+                self.hash_ms.observe((time.perf_counter() - started) * 1000)
+
+        try:
+            future = self._pool().submit(task)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            # still queued: it never runs and its slot is freed, already hashing: it finishes unobserved
+            future.cancel()
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusy("Password check timed out, try again shortly")
+
+    def hash(self, password):
+        # imported on first use, most workers never hash a password
+        import bcrypt
+        salt = bcrypt.gensalt(self.rounds)
+        return self._run(bcrypt.hashpw, password.encode("utf-8"), salt).decode("utf-8")
+
+    def check(self, password, hashed):
+        import bcrypt
+        return self._run(bcrypt.checkpw, password.encode("utf-8"), hashed.encode("utf-8"))
+
+    def needs_rehash(self, hashed):
+        # "$2b$12$<salt+hash>", the second field is the cost
+        try:
+            return int(hashed.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def stats(self):
+        return {
+            "rounds": self.rounds,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+            "queue_wait_ms": self.queue_wait_ms.snapshot(),
+            "hash_ms": self.hash_ms.snapshot(),
+        }
+
+
+password_hasher = PasswordHasher()
+
+
+def setup_hashing(app):
+    workers = int(os.getenv("HASH_WORKERS", os.cpu_count() or 2))
+    password_hasher.configure(
+        rounds=int(os.getenv("BCRYPT_ROUNDS", 12)),
+        workers=workers,
+        max_pending=int(os.getenv("HASH_MAX_PENDING", workers * 4)),
+        timeout=float(os.getenv("HASH_TIMEOUT", 10)),
+    )
+    metrics.register("hashing", password_hasher.stats)
+
+    @app.errorhandler(HasherBusy)
+    def handle_hasher_busy(error):
+        response = jsonify(error.to_dict())
+        response.headers["Retry-After"] = "1"
+        return response, error.status_code
@@ -0,0 +1,180 @@
+"""
+Per-request SQL statement counting, reported in the X-Query-Count debug header, and the opt-in request
+profiler: DB and serialization time in Server-Timing, per-endpoint histograms on /metrics and cProfile
+dumps of the slowest sampled requests
+"""
+import os
+import re
+import heapq
+import random
+import cProfile
+import threading
+import time
+from flask import g, request, has_app_context, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import metrics
+
+LATENCY_BUCKETS = [1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        g.query_count = g.get("query_count", 0) + 1
+        if g.get("profiling"):
+            conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _time_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("query_started")
+    if started and has_app_context():
+        add_timing("db", time.perf_counter() - started.pop())
+
+
+def add_timing(name, seconds):
+    # no-op unless the current request is being profiled
+    if has_request_context() and g.get("profiling"):
+        timings = g.setdefault("timings", {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def setup_query_count(app):
+    @app.after_request
+    def add_query_count_header(response):
+        if app.debug or app.config.get("QUERY_COUNT_HEADER"):
+            response.headers["X-Query-Count"] = str(g.get("query_count", 0))
+        return response
+
+
+class EndpointStats:
+    def __init__(self):
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def histograms(self, endpoint):
+        with self._lock:
+            series = self._series.get(endpoint)
+            if series is None:
+                series = self._series[endpoint] = {
+                    "duration": metrics.Histogram(LATENCY_BUCKETS),
+                    "db": metrics.Histogram(LATENCY_BUCKETS),
+                    "size": metrics.Histogram(SIZE_BUCKETS),
+                }
+            return series
+
+    def observe(self, endpoint, duration_ms, db_ms, size):
+        series = self.histograms(endpoint)
+        series["duration"].observe(duration_ms)
+        series["db"].observe(db_ms)
+        if size is not None:
+            series["size"].observe(size)
+
+    def prometheus_text(self):
+        with self._lock:
+            series = sorted(self._series.items())
+        labeled = [({"method": method, "endpoint": rule}, histograms) for (method, rule), histograms in series]
+        lines = metrics.prometheus_histogram("api_request_duration_seconds",
+                                             [(labels, h["duration"]) for labels, h in labeled], scale=0.001)
+        lines += metrics.prometheus_histogram("api_request_db_seconds",
+                                              [(labels, h["db"]) for labels, h in labeled], scale=0.001)
+        lines += metrics.prometheus_histogram("api_response_size_bytes",
+                                              [(labels, h["size"]) for labels, h in labeled])
+        return lines
+
+
+class SlowestProfiles:
+    # keeps the cProfile dumps of the `keep` slowest sampled requests in `directory`
+    def __init__(self, directory, keep):
+        self.directory = directory
+        self.keep = keep
+        self._kept = []
+        self._lock = threading.Lock()
+
+    def offer(self, profile, duration_ms, method, rule):
+        with self._lock:
+            if len(self._kept) >= self.keep and duration_ms <= self._kept[0][0]:
+                return
+            name = re.sub(r"[^A-Za-z0-9]+", "_", rule).strip("_") or "root"
+            path = os.path.join(self.directory, f"{duration_ms:09.1f}ms-{method}-{name}-{time.time_ns()}.prof")
+            os.makedirs(self.directory, exist_ok=True)
+            profile.dump_stats(path)
+            heapq.heappush(self._kept, (duration_ms, path))
+            if len(self._kept) > self.keep:
+                _, evicted = heapq.heappop(self._kept)
+                try:
+                    os.remove(evicted)
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {"kept": len(self._kept), "slowest_ms": max((duration for duration, _ in self._kept), default=None)}
+
+
+endpoint_stats = EndpointStats()
+
+
+def setup_profiling(app):
+    app.config.setdefault("PROFILING", os.getenv("PROFILING") == "1")
+    sample_rate = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+    profiles = SlowestProfiles(os.getenv("PROFILE_DIR", "/tmp/profiles"), int(os.getenv("PROFILE_KEEP", 10)))
+    if sample_rate:
+        metrics.register("profiles", profiles.stats)
+
+    @app.before_request
+    def start_profiling():
+        if not app.config["PROFILING"]:
+            return
+        g.profiling = True
+        g.started = time.perf_counter()
+        if sample_rate and random.random() < sample_rate:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler is already running on this interpreter
+                return
+            g.profile = profile
+
+    @app.after_request
+    def finish_profiling(response):
+        if not g.get("profiling"):
+            return response
+        profile = g.pop("profile", None)
+        if profile is not None:
+            profile.disable()
+        # streamed bodies are produced after this point, their time and size are not included
+        duration_ms = (time.perf_counter() - g.started) * 1000
+        timings = g.get("timings", {})
+        db_ms = timings.get("db", 0.0) * 1000
+        serialize_ms = timings.get("serialize", 0.0) * 1000
+        compress_ms = timings.get("compress", 0.0) * 1000
+        response.headers["Server-Timing"] = ", ".join([
+            f'db;dur={db_ms:.2f};desc="{g.get("query_count", 0)} queries"',
+            f"serialize;dur={serialize_ms:.2f}",
+            f"compress;dur={compress_ms:.2f}",
+            f"total;dur={duration_ms:.2f}",
+        ])
+
+        rule = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        size = None if response.is_streamed else response.calculate_content_length()
+        endpoint_stats.observe((request.method, rule), duration_ms, db_ms, size)
+        if profile is not None:
+            profiles.offer(profile, duration_ms, request.method, rule)
+        return response
+
+    @app.teardown_request
+    def stop_profiler(error=None):
+        profile = g.pop("profile", None)
+        if profile is not None:
+            profile.disable()
+
+
+def prometheus_text():
+    lines = endpoint_stats.prometheus_text()
+    for name, stats in metrics.collect().items():
+        lines += metrics.prometheus_gauges(f"api_{name}", stats)
+    return "\n".join(lines) + "\n"
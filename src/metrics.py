@@ -0,0 +1,125 @@
+"""
+Process-level counters exposed on the internal stats endpoint and, in Prometheus text, on /metrics
+"""
+import os
+import re
+import bisect
+import threading
+from functools import wraps
+from flask import request, jsonify
+
+_providers = {}
+
+
+def register(name, provider):
+    # provider() returns a JSON-serializable dict, evaluated on every scrape
+    _providers[name] = provider
+
+
+def collect():
+    return {name: provider() for name, provider in _providers.items()}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        # upper bounds, a value lands in the first bucket it fits, anything bigger in +Inf
+        self.buckets = list(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * (len(self.buckets) + 1)
+            self._sum = 0.0
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + ["+Inf"], counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {"buckets": buckets, "count": cumulative, "sum": round(total, 6)}
+
+    def quantile(self, q):
+        # linear interpolation inside the bucket, like Prometheus' histogram_quantile
+        with self._lock:
+            counts = list(self._counts)
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def prometheus_histogram(name, series, scale=1.0, quantiles=(0.5, 0.95, 0.99)):
+    # series is [(labels, Histogram)], scale converts the bucket unit (0.001 for ms to seconds)
+    lines = [f"# TYPE {name} histogram"]
+    for labels, histogram in series:
+        snapshot = histogram.snapshot()
+        for bound, count in snapshot["buckets"].items():
+            le = bound if bound == "+Inf" else repr(float(bound) * scale)
+            lines.append(f"{name}_bucket{_label_text({**labels, 'le': le})} {count}")
+        lines.append(f"{name}_sum{_label_text(labels)} {snapshot['sum'] * scale}")
+        lines.append(f"{name}_count{_label_text(labels)} {snapshot['count']}")
+    # the quantiles are estimated from the buckets, for dashboards that do not run histogram_quantile
+    lines.append(f"# TYPE {name}_quantile gauge")
+    for labels, histogram in series:
+        for q in quantiles:
+            value = histogram.quantile(q)
+            if value is not None:
+                lines.append(f"{name}_quantile{_label_text({**labels, 'quantile': q})} {value * scale}")
+    return lines
+
+
+def prometheus_gauges(prefix, stats):
+    # numeric leaves of the registered providers, nested keys joined with underscores
+    lines = []
+    for key, value in stats.items():
+        name = re.sub(r"[^a-zA-Z0-9_]", "_", f"{prefix}_{key}")
+        if key == "buckets":
+            continue
+        if isinstance(value, dict):
+            lines.extend(prometheus_gauges(name, value))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"{name} {value}")
+        elif isinstance(value, bool):
+            lines.append(f"{name} {int(value)}")
+    return lines
+
+
+def internal_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = os.getenv("INTERNAL_API_TOKEN")
+        if token:
+            allowed = request.headers.get("X-Internal-Token") == token
+        else:
+            allowed = request.remote_addr in ("127.0.0.1", "::1")
+        if not allowed:
+            return jsonify({"error": "Not found"}), 404
+        return view(*args, **kwargs)
+    return wrapper
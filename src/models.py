@@ -1,9 +1,18 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, event
 import enum
 from dataclasses import dataclass
+from replicas import RoutingSession
+from swapi import parse_quantity, parse_birth_year
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+
+def numeric_shadow(source, parse, type_=db.BigInteger):
+    # parsed, indexed copy of a numeric string column for range filters and sorting, it has no dataclass
+    # annotation so the JSON stays the same. Core inserts fill it from the default, ORM writes from sync_numeric_shadows
+    return db.Column(type_, index=True, info={"shadow_of": source, "parse": parse},
+                     default=lambda context: parse(context.get_current_parameters().get(source)))
 
 @dataclass
 class Planets(db.Model):
@@ -11,12 +20,12 @@ class Planets(db.Model):
     id:int = db.Column(db.Integer, primary_key=True, nullable=False, unique=True)
     name:str = db.Column(db.String(250), nullable=False, unique=True)
     population:int = db.Column(db.Integer, nullable=False)
-    climate:str = db.Column(db.String(250), nullable=False)
+    climate:str = db.Column(db.String(250), nullable=False, index=True)
     diameter:int = db.Column(db.Integer, nullable=False)
     rotation_period:int = db.Column(db.Integer, nullable=False)
     orbital_period:int = db.Column(db.Integer, nullable=False)
     gravity:str = db.Column(db.String(250), nullable=False)
-    terrain:str = db.Column(db.String(250), nullable=False)
+    terrain:str = db.Column(db.String(250), nullable=False, index=True)
     url:str = db.Column(db.String(250), nullable=False)
     
 
@@ -28,9 +37,9 @@ class Starships(db.Model):
     __tablename__ = 'Starships'
     id:int = db.Column(db.Integer, primary_key=True, nullable=False, unique=True)
     name:str = db.Column(db.String(250), nullable=False, unique=True)
-    model:str = db.Column(db.String(250), nullable=False)
-    starship_class:str = db.Column(db.String(250), nullable=False)
-    manufacturer:str = db.Column(db.String(250), nullable=False)
+    model:str = db.Column(db.String(250), nullable=False, index=True)
+    starship_class:str = db.Column(db.String(250), nullable=False, index=True)
+    manufacturer:str = db.Column(db.String(250), nullable=False, index=True)
     cost_in_credits:str = db.Column(db.String(250), nullable=False)
     length:int = db.Column(db.Integer, nullable=False)
     crew:str = db.Column(db.String(250), nullable=False)
@@ -40,6 +49,12 @@ class Starships(db.Model):
     cargo_capacity:str = db.Column(db.String(250), nullable=False)
     consumables:str = db.Column(db.String(250), nullable=False)
     url:str = db.Column(db.String(250), nullable=False)
+    cost_in_credits_value = numeric_shadow("cost_in_credits", parse_quantity)
+    crew_value = numeric_shadow("crew", parse_quantity)
+    max_atmosphering_speed_value = numeric_shadow("max_atmosphering_speed", parse_quantity)
+    hyperdrive_rating_value = numeric_shadow("hyperdrive_rating", lambda value: parse_quantity(value, float), db.Float)
+    MGLT_value = numeric_shadow("MGLT", parse_quantity)
+    cargo_capacity_value = numeric_shadow("cargo_capacity", parse_quantity)
 
 
     def __repr__(self):
@@ -50,9 +65,9 @@ class Films(db.Model):
     __tablename__ = 'Films'
     id:int = db.Column(db.Integer, primary_key=True, unique=True)
     title:str = db.Column(db.String(250), nullable=False, unique=True)
-    episode_id:int = db.Column(db.Integer, nullable=False)
+    episode_id:int = db.Column(db.Integer, nullable=False, index=True)
     release_date:str = db.Column(db.String(250), nullable=False)
-    director:str = db.Column(db.String(250), nullable=False)
+    director:str = db.Column(db.String(250), nullable=False, index=True)
     producer:str = db.Column(db.String(250), nullable=False)
     opening_crawl:str = db.Column(db.String(250), nullable=False)
     url:str = db.Column(db.String(250), nullable=False)
@@ -69,16 +84,32 @@ class People(db.Model):
     hair_color:str = db.Column(db.String(250), nullable=False)
     eye_color:str = db.Column(db.String(250), nullable=False)
     birth_year:str = db.Column(db.String(250), nullable=False)
-    gender:str = db.Column(db.String(250), nullable=False)
+    gender:str = db.Column(db.String(250), nullable=False, index=True)
     url:str = db.Column(db.String(250), nullable=False)
     height:int = db.Column(db.Integer, nullable=False)
     mass:int = db.Column(db.Integer, nullable=False)
-    homeworld:str = db.Column(db.String(250), ForeignKey("Planets.name"))
+    homeworld:str = db.Column(db.String(250), ForeignKey("Planets.name"), index=True)
+    birth_year_value = numeric_shadow("birth_year", parse_birth_year, db.Float)
    
 
     def __repr__(self):
         return f'<Character {self.name}>'
 
+def numeric_shadows(model):
+    """{source column name: shadow column} of a catalog model"""
+    return {column.info["shadow_of"]: column for column in model.__table__.columns if "shadow_of" in column.info}
+
+
+def sync_numeric_shadows(model):
+    for source, column in numeric_shadows(model).items():
+        def sync(target, value, oldvalue, initiator, shadow=column.key, parse=column.info["parse"]):
+            setattr(target, shadow, parse(value))
+        event.listen(getattr(model, source), "set", sync)
+
+
+sync_numeric_shadows(Starships)
+sync_numeric_shadows(People)
+
 @dataclass
 class User(db.Model):
     __tablename__ = 'User'
@@ -100,6 +131,8 @@ class FavoriteTypeEnum(str,enum.Enum):
 @dataclass
 class Favorites(db.Model):
     __tablename__ = 'Favorites'
+    # also serves as the index for "favorites of user X", user_id is its leading column
+    __table_args__ = (db.UniqueConstraint("user_id", "type", "external_id", name="uq_Favorites_user_id_type_external_id"),)
     id:int = db.Column(db.Integer, primary_key=True, unique=True)
     user_id:int = db.Column(db.Integer, ForeignKey("User.id"), nullable=False)
     external_id:int = db.Column(db.Integer, nullable=False)
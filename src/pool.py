@@ -0,0 +1,102 @@
+"""
+Connection pool settings from the environment and per-worker pool metrics
+"""
+import os
+import time
+import threading
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+import metrics
+
+# checkout wait in milliseconds
+WAIT_BUCKETS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000]
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.wait_ms = metrics.Histogram(WAIT_BUCKETS)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.connects = 0
+            self.invalidations = 0
+            self.timeouts = 0
+        self.wait_ms.reset()
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(QueuePool):
+    def connect(self):
+        # everything the request waits for: a free slot, a new connection, the pre-ping
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            pool_metrics.count("timeouts")
+            raise
+        finally:
+            pool_metrics.wait_ms.observe((time.perf_counter() - started) * 1000)
+
+
+@event.listens_for(InstrumentedQueuePool, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_metrics.count("checkouts")
+
+
+@event.listens_for(InstrumentedQueuePool, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    pool_metrics.count("connects")
+
+
+@event.listens_for(InstrumentedQueuePool, "invalidate")
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    pool_metrics.count("invalidations")
+
+
+def engine_options(database_url):
+    # a pool per worker: size + overflow should stay under max_connections / workers
+    if database_url.startswith("sqlite") and (":memory:" in database_url or database_url.rstrip("/") == "sqlite:"):
+        return {}
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1") == "1",
+    }
+    return options
+
+
+def setup_pool_metrics(app, db):
+    def stats():
+        with app.app_context():
+            pool = db.engine.pool
+        snapshot = {
+            "checkouts": pool_metrics.checkouts,
+            "connects": pool_metrics.connects,
+            "invalidations": pool_metrics.invalidations,
+            "timeouts": pool_metrics.timeouts,
+            "wait_ms": pool_metrics.wait_ms.snapshot(),
+        }
+        if isinstance(pool, QueuePool):
+            snapshot.update(size=pool.size(), checked_out=pool.checkedout(), overflow=max(pool.overflow(), 0))
+        return snapshot
+    metrics.register("pool", stats)
+
+
+def dispose_after_fork(app, db):
+    # connections opened in the gunicorn master must not be shared with the forked worker
+    with app.app_context():
+        db.engine.dispose(close=False)
+    pool_metrics.reset()
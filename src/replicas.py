@@ -0,0 +1,122 @@
+"""
+Routes the reads of read-only routes to DATABASE_REPLICA_URLS, with round-robin and failover to the primary
+"""
+import os
+import time
+import threading
+from functools import wraps
+from itertools import count
+from flask import g, request, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, text
+
+# set after any successful write so the same client keeps reading from the primary while replicas catch up
+STICKY_COOKIE = "read_primary_until"
+
+
+class ReplicaSet:
+    def __init__(self):
+        self.engines = []
+        self.check_interval = 5
+        self.lag_window = 5
+        self._turn = count()
+        self._health = {}
+        self._lock = threading.Lock()
+
+    def configure(self, urls, engine_options, check_interval, lag_window):
+        self.engines = [create_engine(url, **engine_options) for url in urls]
+        self.check_interval = check_interval
+        self.lag_window = lag_window
+        self._health = {}
+
+    def _healthy(self, engine):
+        now = time.monotonic()
+        with self._lock:
+            healthy, checked = self._health.get(engine, (True, None))
+            if checked is not None and now - checked < self.check_interval:
+                return healthy
+            # claim the check so concurrent requests keep using the last known state
+            self._health[engine] = (healthy, now)
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            healthy = True
+        except Exception:
+            healthy = False
+        with self._lock:
+            self._health[engine] = (healthy, time.monotonic())
+        return healthy
+
+    def pick(self):
+        if not self.engines:
+            return None
+        start = next(self._turn)
+        for offset in range(len(self.engines)):
+            engine = self.engines[(start + offset) % len(self.engines)]
+            if self._healthy(engine):
+                return engine
+        return None
+
+    def stats(self):
+        with self._lock:
+            return [{"url": engine.url.render_as_string(hide_password=True), "healthy": self._health.get(engine, (True, None))[0]}
+                    for engine in self.engines]
+
+
+replica_set = ReplicaSet()
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and self._reads_from_replica():
+            engine = replica_set.pick()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _reads_from_replica(self):
+        if not has_request_context() or not g.get("read_replica"):
+            return False
+        # anything this session is about to write must be read back from the primary
+        return not (self.new or self.dirty or self.deleted)
+
+
+def may_be_stale(modified_at):
+    # a replica read shortly after a write may not include it yet
+    return bool(replica_set.engines) and has_request_context() and bool(g.get("read_replica")) \
+        and time.time() - modified_at < replica_set.lag_window
+
+
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            pinned = float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            pinned = False
+        g.read_replica = not pinned
+        g.read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def setup_replicas(app):
+    urls = [url.strip().replace("postgres://", "postgresql://")
+            for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+    if not urls:
+        return
+    sticky_seconds = int(os.getenv("REPLICA_STICKY_SECONDS", 5))
+    replica_set.configure(urls, app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}),
+                          int(os.getenv("REPLICA_HEALTH_INTERVAL", 5)), sticky_seconds)
+
+    @app.after_request
+    def pin_writer_to_primary(response):
+        # POST /batch only reads
+        if request.method in ("POST", "PUT", "PATCH", "DELETE") and not g.get("read_only") and response.status_code < 400:
+            secure = app.config.get("JWT_COOKIE_SECURE", False)
+            response.set_cookie(STICKY_COOKIE, str(time.time() + sticky_seconds), max_age=sticky_seconds,
+                                httponly=True, secure=secure, samesite="None" if secure else "Lax")
+        return response
+
+    import metrics
+    metrics.register("replicas", replica_set.stats)
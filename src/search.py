@@ -0,0 +1,205 @@
+"""
+In-process trigram index over the catalog text columns for /search, kept current through the change events
+
+Writes this process did not see (another worker, `flask catalog load`) move a table version past the
+one the index expects, it is then rebuilt on the next search.
+"""
+import re
+import time
+import threading
+from array import array
+from collections import Counter
+from models import db, People, Planets, Films, Starships
+from versions import table_versions
+import changes
+import metrics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the first column is the label shown in results and weighs most in the ranking
+SEARCH_FIELDS = {
+    People: ["name", "homeworld", "gender"],
+    Planets: ["name", "climate", "terrain"],
+    Films: ["title", "director", "producer"],
+    Starships: ["name", "model", "manufacturer", "starship_class"],
+}
+MODELS_BY_TABLE = {model.__tablename__: model for model in SEARCH_FIELDS}
+
+# candidates come from the rarest trigrams of the query until this many postings were read,
+# the exact ranking then only looks at the best MAX_CANDIDATES of them. Postings are kept per
+# table so a ?type= search reads and ranks only the tables asked for
+POSTINGS_BUDGET = 2000
+MAX_CANDIDATES = 50
+MIN_SCORE = 0.2
+SECONDARY_WEIGHT = 0.8
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def trigrams(text):
+    # pg_trgm style: every word padded with two spaces in front and one behind
+    grams = set()
+    for word in WORD.findall(str(text).lower()):
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+
+def top_candidates(postings, dead, size):
+    """The (doc id, hits) of the size documents found in the most of the posting arrays, removed ones left out"""
+    postings = [doc_ids for doc_ids in postings if doc_ids]
+    if not postings:
+        return []
+    if numpy is not None:
+        # sorting and counting in C, the arrays are read in place
+        doc_ids, hits = numpy.unique(numpy.concatenate([numpy.frombuffer(doc_ids, dtype=numpy.uint32)
+                                                        for doc_ids in postings]), return_counts=True)
+        if dead:
+            alive = ~numpy.isin(doc_ids, numpy.fromiter(dead, dtype=numpy.uint32, count=len(dead)))
+            doc_ids, hits = doc_ids[alive], hits[alive]
+        if doc_ids.size > size:
+            best = numpy.argpartition(-hits, size)[:size]
+            doc_ids, hits = doc_ids[best], hits[best]
+        return list(zip(doc_ids.tolist(), hits.tolist()))
+    counts = Counter()
+    for doc_ids in postings:
+        counts.update(doc_ids)
+    for doc_id in [doc_id for doc_id in dead if doc_id in counts]:
+        del counts[doc_id]
+    return counts.most_common(size)
+
+
+class SearchIndex:
+    def __init__(self):
+        self._docs = []
+        self._keys = {}
+        self._gram_ids = {}
+        self._postings = {table: [] for table in MODELS_BY_TABLE}
+        self._dead = set()
+        self._built = False
+        # table -> the version the index matches, followed by this process's own commits
+        self._versions = {}
+        self._lock = threading.RLock()
+        self.build_seconds = None
+
+    def _ids(self, grams, create=False):
+        # trigrams are stored once as small ints, documents and postings only hold the ids
+        ids = set()
+        for gram in grams:
+            gram_id = self._gram_ids.get(gram)
+            if gram_id is None and create:
+                gram_id = self._gram_ids[gram] = len(self._gram_ids)
+                for postings in self._postings.values():
+                    postings.append(array("I"))
+            if gram_id is not None:
+                ids.add(gram_id)
+        return ids
+
+    def _add(self, table, row_id, values):
+        fields = SEARCH_FIELDS[MODELS_BY_TABLE[table]]
+        label = values.get(fields[0]) or ""
+        label_ids = frozenset(self._ids(trigrams(label), create=True))
+        other_ids = self._ids(set().union(*(trigrams(values.get(field) or "") for field in fields[1:])), create=True)
+        doc_id = len(self._docs)
+        self._docs.append((table, row_id, label, label.lower(), label_ids))
+        self._keys[(table, row_id)] = doc_id
+        postings = self._postings[table]
+        for gram_id in label_ids.union(other_ids):
+            postings[gram_id].append(doc_id)
+
+    def _remove(self, table, row_id):
+        # postings keep the id, the document slot is emptied and skipped until the next rebuild
+        doc_id = self._keys.pop((table, row_id), None)
+        if doc_id is not None:
+            self._docs[doc_id] = None
+            self._dead.add(doc_id)
+
+    def build(self):
+        started = time.perf_counter()
+        with self._lock:
+            self._versions = dict(zip(MODELS_BY_TABLE, table_versions.get(tuple(MODELS_BY_TABLE))))
+            self._docs, self._keys, self._gram_ids, self._dead = [], {}, {}, set()
+            self._postings = {table: [] for table in MODELS_BY_TABLE}
+            for model, fields in SEARCH_FIELDS.items():
+                columns = [model.id] + [getattr(model, field) for field in fields]
+                rows = db.session.execute(db.select(*columns).execution_options(yield_per=5000))
+                for row in rows:
+                    self._add(model.__tablename__, row.id, row._asdict())
+            self._built = True
+        self.build_seconds = time.perf_counter() - started
+
+    def apply(self, changed):
+        with self._lock:
+            if not self._built:
+                return
+            for table in {change.table for change in changed}.intersection(self._versions):
+                self._versions[table] += 1
+            for change in changed:
+                if change.table not in MODELS_BY_TABLE:
+                    continue
+                if change.values is None:
+                    # bulk loads do not say which rows changed
+                    self._built = False
+                    return
+                self._remove(change.table, change.id)
+                if change.op != "delete":
+                    self._add(change.table, change.id, change.values)
+            if len(self._dead) > len(self._keys):
+                self._built = False
+
+    def search(self, query, tables=None, limit=20):
+        with self._lock:
+            if not self._built or tuple(self._versions.values()) != table_versions.get(tuple(self._versions)):
+                self.build()
+            query_ids = self._ids(trigrams(query))
+            searched = [self._postings[table] for table in (tables or MODELS_BY_TABLE) if table in self._postings]
+            selected = []
+            used = 0
+            read = 0
+            for gram_id in sorted(query_ids, key=lambda gram_id: sum(len(postings[gram_id]) for postings in searched)):
+                if read >= POSTINGS_BUDGET and used >= 2:
+                    break
+                for postings in searched:
+                    selected.append(postings[gram_id])
+                    read += len(postings[gram_id])
+                used += 1
+
+            needle = query.strip().lower()
+            query_size = len(trigrams(query))
+            results = []
+            # removed documents are dropped before the cut, they would otherwise take candidate places
+            for doc_id, hits in top_candidates(selected, self._dead, MAX_CANDIDATES):
+                table, row_id, label, label_lower, label_ids = self._docs[doc_id]
+                shared = len(query_ids & label_ids)
+                # the name/title is ranked exactly, other columns by a lower bound: unread trigrams count as misses
+                score = max(shared / (query_size + len(label_ids) - shared), SECONDARY_WEIGHT * hits / query_size)
+                if label_lower == needle:
+                    score += 1.0
+                elif label_lower.startswith(needle):
+                    score += 0.5
+                if score >= MIN_SCORE:
+                    results.append((score, table, row_id, label))
+        results.sort(key=lambda result: -result[0])
+        return [{"type": table, "id": row_id, "name": label, "score": round(score, 3)}
+                for score, table, row_id, label in results[:limit]]
+
+    def stats(self):
+        with self._lock:
+            return {"built": self._built, "documents": len(self._keys), "dead": len(self._dead),
+                    "trigrams": len(self._gram_ids), "build_seconds": self.build_seconds}
+
+
+search_index = SearchIndex()
+
+
+@changes.on_change
+def _update_index(changed):
+    search_index.apply(changed)
+
+
+def setup_search(app):
+    changes.watch(*SEARCH_FIELDS)
+    metrics.register("search", search_index.stats)
@@ -0,0 +1,89 @@
+"""
+Fast JSON encoding for the dataclass models, using orjson when it is installed
+"""
+import json
+import time
+import decimal
+import dataclasses
+from datetime import date
+from operator import attrgetter
+from flask.json.provider import JSONProvider
+from werkzeug.http import http_date
+from instrumentation import add_timing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_encoders = {}
+
+
+def encoder_for(model):
+    # column names and their getter are computed once per model instead of per row
+    encoder = _encoders.get(model)
+    if encoder is None:
+        names = tuple(field.name for field in dataclasses.fields(model))
+        getter = attrgetter(*names)
+        if len(names) == 1:
+            def encoder(obj):
+                return {names[0]: getter(obj)}
+        else:
+            def encoder(obj):
+                return dict(zip(names, getter(obj)))
+        _encoders[model] = encoder
+    return encoder
+
+
+def _default(obj):
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return encoder_for(type(obj))(obj)
+    if hasattr(obj, "_asdict"):
+        return obj._asdict()
+    if isinstance(obj, date):
+        return http_date(obj)
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+else:
+    _encoder = json.JSONEncoder(separators=(",", ":"), default=_default)
+
+    def dumps(obj):
+        return _encoder.encode(obj).encode("utf-8")
+
+
+def stream_list(items, prefix=b"", suffix=b""):
+    # yields a JSON array one element at a time so the whole list is never in memory
+    yield prefix + b"["
+    first = True
+    for item in items:
+        if first:
+            first = False
+            yield dumps(item)
+        else:
+            yield b"," + dumps(item)
+    yield b"]" + suffix + b"\n"
+
+
+class FastJSONProvider(JSONProvider):
+    mimetype = "application/json"
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return json.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        started = time.perf_counter()
+        body = dumps(obj) + b"\n"
+        add_timing("serialize", time.perf_counter() - started)
+        return self._app.response_class(body, mimetype=self.mimetype)
@@ -0,0 +1,273 @@
+"""
+Response cache and table generations in one shared memory file, mapped by every worker on the host
+
+SHARED_CACHE_PATH=/dev/shm/starwars-api-cache turns it on. The table versions (so ETags and
+Last-Modified) then come from generation counters in the file: a commit in any worker, the admin
+included, bumps them and every worker sees the new value on its next read. A cached body is
+stamped with the sum of its tables' generations when stored and is stale once that sum moved,
+nothing has to be deleted.
+
+Nothing ever unlinks the file, a preloading gunicorn master has it mapped before its hooks run.
+gunicorn.conf.py calls reset_segment() once when the master starts instead: a fresh boot id, every
+generation back to 0 and every slot emptied, in place.
+
+SHARED_CACHE_SLOTS (1024) slots of SHARED_CACHE_SLOT_KB (128) KB each are an upper bound: the count
+is lowered to fit in half the free space of the file system, down to 0 (no shared bodies, the
+generations still are) when it is full.
+
+Bodies live in fixed size slots, a key can only go into the SHARED_CACHE_PROBE slots after its hash,
+when they are all taken the least recently used of them is overwritten. Readers take no lock, every
+slot has a sequence number that is odd while a writer is in it (a seqlock), a read that overlapped a
+write counts as a miss. Writers serialize on flock.
+"""
+import os
+import time
+import fcntl
+import mmap
+import zlib
+import struct
+import hashlib
+import threading
+from contextlib import contextmanager
+import metrics
+from versions import table_versions
+from cache import response_cache
+
+MAGIC = b"SWSHM001"
+# magic, boot id, created, slot count, slot size
+HEADER = struct.Struct("<8s8sdQQ")
+GENERATIONS = 64
+GENERATIONS_OFFSET = 64
+MODIFIED_OFFSET = GENERATIONS_OFFSET + GENERATIONS * 8
+# time of the last data write, snapshot swaps bump the generation but do not count, 0 when never
+WRITTEN_OFFSET = MODIFIED_OFFSET + GENERATIONS * 8
+SLOTS_OFFSET = 4096
+# sequence, key hash, stamp, table mask, expires, last used, key length, body length
+SLOT = struct.Struct("<QQQQddII")
+LAST_USED_OFFSET = 40
+U64 = struct.Struct("<Q")
+F64 = struct.Struct("<d")
+
+
+def generation_index(table):
+    # tables share a counter when their names collide, that only invalidates more than needed
+    return zlib.crc32(table.encode("utf-8")) % GENERATIONS
+
+
+class SharedSegment:
+    def __init__(self, path, slots, slot_size, probe=8):
+        self.path = path
+        self.probe = probe
+        self._fd = None
+        self._pid = None
+        self._thread_lock = threading.Lock()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            size = SLOTS_OFFSET + slots * slot_size
+            if os.fstat(fd).st_size == 0:
+                # the pages stay unallocated until a slot is first written
+                os.ftruncate(fd, size)
+                os.pwrite(fd, HEADER.pack(MAGIC, os.urandom(8), time.time(), slots, slot_size), 0)
+            self.buffer = mmap.mmap(fd, 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        magic, _, _, self.slots, self.slot_size = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC or (self.slots, self.slot_size) != (slots, slot_size):
+            raise ValueError(f"{path} was created with another layout, remove it or change SHARED_CACHE_PATH")
+
+    # read from the header every time, reset_segment() rewrites them under a live mapping
+
+    @property
+    def boot_id(self):
+        return HEADER.unpack_from(self.buffer)[1].hex()
+
+    @property
+    def created(self):
+        return HEADER.unpack_from(self.buffer)[2]
+
+    @contextmanager
+    def lock(self):
+        # flock belongs to the open file, a descriptor inherited through fork() would be shared with the parent
+        with self._thread_lock:
+            if self._pid != os.getpid():
+                self._fd = os.open(self.path, os.O_RDWR)
+                self._pid = os.getpid()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    # generations
+
+    def generations(self, tables):
+        return tuple(U64.unpack_from(self.buffer, GENERATIONS_OFFSET + generation_index(table) * 8)[0]
+                     for table in tables)
+
+    def modified(self, tables):
+        return max(F64.unpack_from(self.buffer, MODIFIED_OFFSET + generation_index(table) * 8)[0] or self.created
+                   for table in tables)
+
+    def written(self, tables):
+        return max(F64.unpack_from(self.buffer, WRITTEN_OFFSET + generation_index(table) * 8)[0] for table in tables)
+
+    def bump(self, tables, written=()):
+        now = time.time()
+        with self.lock():
+            for index in {generation_index(table) for table in tables}:
+                offset = GENERATIONS_OFFSET + index * 8
+                U64.pack_into(self.buffer, offset, U64.unpack_from(self.buffer, offset)[0] + 1)
+                F64.pack_into(self.buffer, MODIFIED_OFFSET + index * 8, now)
+            for index in {generation_index(table) for table in written}:
+                F64.pack_into(self.buffer, WRITTEN_OFFSET + index * 8, now)
+
+    def stamp(self, tables, versions):
+        # versions is what generations(tables) returned, colliding tables count once
+        by_index = dict(zip((generation_index(table) for table in tables), versions))
+        return sum(1 << index for index in by_index), sum(by_index.values())
+
+    def current_stamp(self, mask):
+        stamp = 0
+        while mask:
+            index = (mask & -mask).bit_length() - 1
+            stamp += U64.unpack_from(self.buffer, GENERATIONS_OFFSET + index * 8)[0]
+            mask &= mask - 1
+        return stamp
+
+    # slots
+
+    def _slot_offset(self, index):
+        return SLOTS_OFFSET + index * self.slot_size
+
+    def _candidates(self, key_hash):
+        start = key_hash % self.slots
+        return [(start + step) % self.slots for step in range(min(self.probe, self.slots))]
+
+    def get(self, key):
+        """The body stored under key bytes, None when missing, expired, stale or being written"""
+        key_hash = _hash(key)
+        for index in self._candidates(key_hash):
+            offset = self._slot_offset(index)
+            sequence, slot_hash, stamp, mask, expires, _, key_length, body_length = SLOT.unpack_from(self.buffer, offset)
+            if slot_hash != key_hash or sequence & 1:
+                continue
+            start = offset + SLOT.size
+            if self.buffer[start:start + key_length] != key:
+                continue
+            body = self.buffer[start + key_length:start + key_length + body_length]
+            if U64.unpack_from(self.buffer, offset)[0] != sequence:
+                return None
+            if expires < time.time() or stamp != self.current_stamp(mask):
+                return None
+            # only steers eviction, a lost update does no harm
+            F64.pack_into(self.buffer, offset + LAST_USED_OFFSET, time.time())
+            return body
+        return None
+
+    def set(self, key, tables, versions, body, ttl):
+        """Stores body if it fits a slot, versions are the generations read before the body was built"""
+        if SLOT.size + len(key) + len(body) > self.slot_size:
+            return False
+        key_hash = _hash(key)
+        mask, stamp = self.stamp(tables, versions)
+        with self.lock():
+            index = self._victim(key_hash)
+            offset = self._slot_offset(index)
+            sequence = U64.unpack_from(self.buffer, offset)[0]
+            U64.pack_into(self.buffer, offset, sequence + 1)
+            start = offset + SLOT.size
+            self.buffer[start:start + len(key)] = key
+            self.buffer[start + len(key):start + len(key) + len(body)] = body
+            SLOT.pack_into(self.buffer, offset, sequence + 1, key_hash, stamp, mask, time.time() + ttl,
+                           time.time(), len(key), len(body))
+            U64.pack_into(self.buffer, offset, sequence + 2)
+        return True
+
+    def _victim(self, key_hash):
+        # the slot that already holds this key, else an empty, expired or stale one, else the least recently used
+        slots = [(index, SLOT.unpack_from(self.buffer, self._slot_offset(index))) for index in self._candidates(key_hash)]
+        for index, (_, slot_hash, _, _, _, _, _, _) in slots:
+            if slot_hash == key_hash:
+                return index
+        now = time.time()
+        for index, (_, slot_hash, stamp, mask, expires, _, _, _) in slots:
+            if slot_hash == 0 or expires < now or stamp != self.current_stamp(mask):
+                return index
+        return min(slots, key=lambda slot: slot[1][5])[0]
+
+    def clear(self):
+        with self.lock():
+            for index in range(self.slots):
+                offset = self._slot_offset(index)
+                if U64.unpack_from(self.buffer, offset + 8)[0]:
+                    SLOT.pack_into(self.buffer, offset, U64.unpack_from(self.buffer, offset)[0] + 2, 0, 0, 0, 0, 0, 0, 0)
+
+    def occupancy(self):
+        # walks every slot header, for /internal/stats only
+        now, used = time.time(), 0
+        for index in range(self.slots):
+            _, slot_hash, stamp, mask, expires, _, _, _ = SLOT.unpack_from(self.buffer, self._slot_offset(index))
+            used += bool(slot_hash) and expires >= now and stamp == self.current_stamp(mask)
+        return used
+
+
+def reset_segment(path):
+    """Starts an existing segment over for a new deployment, in place so live mappings stay valid"""
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        header = os.pread(fd, HEADER.size, 0)
+        if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+            return
+        _, _, _, slots, slot_size = HEADER.unpack(header)
+        os.pwrite(fd, bytes(SLOTS_OFFSET - GENERATIONS_OFFSET), GENERATIONS_OFFSET)
+        empty = bytes(SLOT.size)
+        for index in range(slots):
+            os.pwrite(fd, empty, SLOTS_OFFSET + index * slot_size)
+        # last, a reader that sees the new boot id also sees the zeroed generations
+        os.pwrite(fd, HEADER.pack(MAGIC, os.urandom(8), time.time(), slots, slot_size), 0)
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _hash(key):
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+
+def fitting_slots(path, slots, slot_size):
+    """Lowers slots to what the file system of path has room for, 0 when not even one slot fits"""
+    # the file is sparse, a worker writing to a page /dev/shm (64 MB in a Docker container) cannot
+    # back gets a SIGBUS rather than an error
+    try:
+        with open(path, "rb") as file:
+            magic, _, _, existing, existing_size = HEADER.unpack(file.read(HEADER.size))
+        if magic == MAGIC and existing_size == slot_size and existing <= slots:
+            # sized by the process that created it, a later one must map the same layout
+            return existing
+    except (FileNotFoundError, struct.error):
+        pass
+    stat = os.statvfs(os.path.dirname(os.path.abspath(path)))
+    # half of the free space at most, other processes write there too
+    return max(min(slots, (stat.f_bavail * stat.f_frsize // 2 - SLOTS_OFFSET) // slot_size), 0)
+
+
+def setup_shared_cache(app):
+    path = os.getenv("SHARED_CACHE_PATH")
+    if not path:
+        return
+    slot_size = int(os.getenv("SHARED_CACHE_SLOT_KB", 128)) * 1024
+    slots = fitting_slots(path, int(os.getenv("SHARED_CACHE_SLOTS", 1024)), slot_size)
+    segment = SharedSegment(path, slots, slot_size, int(os.getenv("SHARED_CACHE_PROBE", 8)))
+    table_versions.attach(segment)
+    if slots:
+        # with no room for bodies the workers still share the table versions
+        response_cache.shared = segment
+    metrics.register("shared_cache", lambda: {"path": path, "slots": segment.slots, "slot_size": segment.slot_size,
+                                              "live_entries": segment.occupancy()})
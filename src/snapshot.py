@@ -0,0 +1,229 @@
+"""
+Read-only catalog snapshot: every catalog row pre-encoded as JSON in one file with an id -> offset index per table
+
+`flask catalog snapshot` writes it, the list and item endpoints serve from an mmap of it when
+CATALOG_SNAPSHOT_PATH is set. The pages live in the OS page cache, shared by every worker.
+
+Layout: header (magic, toc offset, toc length), then per table the JSON bodies back to back and
+an index of (id, offset, length) records sorted by id, then the JSON table of contents.
+A table written to since the snapshot was taken is served from the database again. With the table
+versions shared between workers (see versions) that is a write from any of them, otherwise only
+this process's own writes count and the others show up once the snapshot is regenerated.
+"""
+import os
+import json
+import mmap
+import time
+import struct
+import bisect
+import tempfile
+import threading
+from functools import wraps
+from flask import request, current_app
+import changes
+import metrics
+from models import db, People, Planets, Films, Starships
+from catalog import page_args
+from serializer import dumps, encoder_for
+from versions import table_versions
+
+MAGIC = b"SWSNAP01"
+HEADER = struct.Struct("<8sQQ")
+INDEX_ENTRY = struct.Struct("<qQI")
+SNAPSHOT_MODELS = (People, Planets, Films, Starships)
+# list requests with any other argument (filters, fields, expand) go to the database
+PAGE_ARGS = {"after", "limit"}
+
+
+def write_snapshot(path, batch_size=1000):
+    """Writes the snapshot next to `path` and renames it over it, readers see the old or the new file, never half of one"""
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary = tempfile.mkstemp(prefix=".snapshot-", dir=directory)
+    toc = {"created": time.time(), "tables": {}}
+    try:
+        with os.fdopen(handle, "wb") as file:
+            file.write(HEADER.pack(MAGIC, 0, 0))
+            for model in SNAPSHOT_MODELS:
+                encode = encoder_for(model)
+                index = []
+                data_offset = file.tell()
+                query = db.select(model).order_by(model.id).execution_options(yield_per=batch_size)
+                for row in db.session.execute(query).scalars():
+                    body = dumps(encode(row))
+                    index.append(INDEX_ENTRY.pack(row.id, file.tell(), len(body)))
+                    file.write(body)
+                index_offset = file.tell()
+                file.write(b"".join(index))
+                toc["tables"][model.__tablename__] = {"data_offset": data_offset, "index_offset": index_offset,
+                                                      "count": len(index)}
+                db.session.expunge_all()
+            toc_bytes = json.dumps(toc).encode("utf-8")
+            toc_offset = file.tell()
+            file.write(toc_bytes)
+            file.seek(0)
+            file.write(HEADER.pack(MAGIC, toc_offset, len(toc_bytes)))
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return toc
+
+
+class _Ids:
+    # sequence view of the ids in a table index, for bisect
+    def __init__(self, buffer, offset, count):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        return INDEX_ENTRY.unpack_from(self.buffer, self.offset + position * INDEX_ENTRY.size)[0]
+
+
+class SnapshotFile:
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.stat = os.fstat(file.fileno())
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, toc_offset, toc_length = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        toc = json.loads(self.buffer[toc_offset:toc_offset + toc_length])
+        self.created = toc["created"]
+        self.tables = {name: _Ids(self.buffer, table["index_offset"], table["count"])
+                       for name, table in toc["tables"].items()}
+
+    def _body(self, ids, position):
+        _, offset, length = INDEX_ENTRY.unpack_from(self.buffer, ids.offset + position * INDEX_ENTRY.size)
+        return self.buffer[offset:offset + length]
+
+    def item(self, table, item_id):
+        ids = self.tables[table]
+        position = bisect.bisect_left(ids, item_id)
+        if position < len(ids) and ids[position] == item_id:
+            return self._body(ids, position)
+        return None
+
+    def page(self, table, after, limit):
+        # the same {"results", "next"} page as catalog.build_page
+        ids = self.tables[table]
+        start = bisect.bisect_right(ids, after) if after is not None else 0
+        end = min(start + limit, len(ids))
+        results = b",".join(self._body(ids, position) for position in range(start, end))
+        next_cursor = str(ids[end - 1]).encode() if end < len(ids) and end > start else b"null"
+        return b'{"results":[' + results + b'],"next":' + next_cursor + b"}"
+
+
+class CatalogSnapshot:
+    def __init__(self):
+        self.path = None
+        self.check_interval = 1.0
+        self._file = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.fallbacks = 0
+        self.reloads = 0
+
+    def configure(self, path, check_interval):
+        self.path = path
+        self.check_interval = check_interval
+        self._file = None
+        self._checked = 0.0
+
+    def current(self):
+        if self.path is None:
+            return None
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return self._file
+        with self._lock:
+            if now - self._checked >= self.check_interval:
+                self._checked = now
+                self._file = self._reload()
+        return self._file
+
+    def _reload(self):
+        # a regenerated file has a new inode, the old mapping stays valid until its last reader drops it
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        if self._file is not None and (self._file.stat.st_ino, self._file.stat.st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns):
+            return self._file
+        try:
+            snapshot = SnapshotFile(self.path)
+        except (OSError, ValueError):
+            return None
+        if self._file is not None:
+            # the catalog changed somewhere else, ETags, cached responses and the search index follow the new file
+            changes.notify([changes.Change(table, "snapshot", None) for table in snapshot.tables])
+        self.reloads += 1
+        return snapshot
+
+    def usable(self, table):
+        snapshot = self.current()
+        if snapshot is None or table not in snapshot.tables:
+            return None
+        if table_versions.last_written((table,)) >= snapshot.created:
+            return None
+        return snapshot
+
+    def response_body(self, model, args, item_id=None):
+        if self.path is None:
+            return None
+        snapshot = self.usable(model.__tablename__)
+        if snapshot is None or (item_id is not None and args) or not PAGE_ARGS.issuperset(args):
+            self.fallbacks += 1
+            return None
+        self.hits += 1
+        if item_id is not None:
+            body = snapshot.item(model.__tablename__, item_id)
+            return (body if body is not None else b"null") + b"\n"
+        after, limit = page_args(args)
+        return snapshot.page(model.__tablename__, after, limit) + b"\n"
+
+    def stats(self):
+        snapshot = self._file
+        return {
+            "path": self.path,
+            "created": snapshot.created if snapshot else None,
+            "rows": {name: len(ids) for name, ids in snapshot.tables.items()} if snapshot else {},
+            "hits": self.hits,
+            "fallbacks": self.fallbacks,
+            "reloads": self.reloads,
+        }
+
+
+catalog_snapshot = CatalogSnapshot()
+
+
+def from_snapshot(model):
+    # goes between @conditional and @cached, a snapshot hit needs neither the database nor the response cache
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            body = catalog_snapshot.response_body(model, request.args, kwargs.get("id"))
+            if body is None:
+                return view(*args, **kwargs)
+            response = current_app.response_class(body, mimetype="application/json")
+            response.headers["X-Snapshot"] = "HIT"
+            return response
+        return wrapper
+    return decorator
+
+
+def setup_snapshot(app):
+    path = os.getenv("CATALOG_SNAPSHOT_PATH")
+    if not path:
+        return
+    catalog_snapshot.configure(path, float(os.getenv("CATALOG_SNAPSHOT_CHECK_INTERVAL", 1)))
+    changes.watch(*SNAPSHOT_MODELS)
+    metrics.register("snapshot", catalog_snapshot.stats)
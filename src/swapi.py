@@ -0,0 +1,67 @@
+"""
+Normalization of SWAPI-shaped records into the column types of the catalog models
+"""
+import re
+from sqlalchemy import Integer, String
+
+UNKNOWN = {"", "unknown", "n/a", "none", "indefinite"}
+
+
+def parse_number(value, cast=int):
+    # "1,000,000" -> 1000000, "unknown" -> None, "78.2" -> 78 for integer columns
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            return cast(value)
+        text = str(value).strip().lower().replace(",", "")
+        if text in UNKNOWN:
+            return None
+        return cast(float(text)) if cast is int else cast(text)
+    except (ValueError, OverflowError):
+        # "inf", "nan" and numbers too large for the column read as unknown
+        return None
+
+
+def parse_quantity(value, cast=int):
+    # "1000km" -> 1000, "30-165" -> 165, a range keeps its upper end
+    if isinstance(value, str):
+        numbers = re.findall(r"\d[\d,]*(?:\.\d+)?", value)
+        value = numbers[-1] if numbers and value.strip().lower() not in UNKNOWN else None
+    return parse_number(value, cast)
+
+
+def parse_birth_year(value):
+    # "19BBY" -> -19.0, "22ABY" -> 22.0, years before the Battle of Yavin are negative
+    if not isinstance(value, str):
+        return parse_number(value, float)
+    text = value.strip().upper()
+    sign = -1 if text.endswith("BBY") else 1
+    year = parse_number(text.removesuffix("BBY").removesuffix("ABY"), float)
+    return sign * year if year is not None else None
+
+
+def normalize(model, record, key):
+    """Returns (row, defaulted) with one value per column of model, or (None, 0) if the key is missing"""
+    if not record.get(key):
+        return None, 0
+
+    row = {}
+    defaulted = 0
+    for column in model.__table__.columns:
+        if column.key == "id" or "shadow_of" in column.info:
+            # numeric shadow columns are derived from their source column on insert
+            continue
+        value = record.get(column.key)
+        if isinstance(column.type, Integer):
+            value = parse_number(value)
+            if value is None and not column.nullable:
+                value = 0
+                defaulted += 1
+        elif isinstance(column.type, String):
+            if value is None:
+                value = None if column.nullable else ""
+            else:
+                value = str(value)[:column.type.length]
+        row[column.key] = value
+    return row, defaulted
@@ -0,0 +1,117 @@
+"""
+Per-table version counters and the ETag / Last-Modified conditional GET built on top of them
+
+Without a shared segment (see shared_cache) the counters belong to the process, a write in one
+worker is not seen by the others. gunicorn.conf.py turns the segment on by default for that reason,
+other multi-process servers need SHARED_CACHE_PATH set. Hosts do not share it.
+"""
+import os
+import time
+import hashlib
+import threading
+from functools import wraps
+from flask import request, current_app, make_response, g
+import changes
+
+
+class TableVersions:
+    def __init__(self):
+        # versions restart at 0 with the process, the boot id keeps old ETags from matching
+        self._boot_id = os.urandom(8).hex()
+        self._versions = {}
+        self._modified = {}
+        self._written = {}
+        self._started = time.time()
+        self._lock = threading.Lock()
+        self.shared = None
+
+    def attach(self, segment):
+        # generation counters in shared memory (see shared_cache), every worker then produces the same ETags
+        self.shared = segment
+
+    @property
+    def boot_id(self):
+        return self.shared.boot_id if self.shared is not None else self._boot_id
+
+    def get(self, tables):
+        if self.shared is not None:
+            return self.shared.generations(tables)
+        with self._lock:
+            return tuple(self._versions.get(table, 0) for table in tables)
+
+    def last_modified(self, tables):
+        if self.shared is not None:
+            return self.shared.modified(tables)
+        with self._lock:
+            return max(self._modified.get(table, self._started) for table in tables)
+
+    def last_written(self, tables):
+        # time of the last data write, 0 when there was none since the start
+        if self.shared is not None:
+            return self.shared.written(tables)
+        with self._lock:
+            return max(self._written.get(table, 0) for table in tables)
+
+    def bump(self, tables, written=()):
+        # written are the tables whose rows changed, not just the file they are served from
+        if self.shared is not None:
+            return self.shared.bump(tables, written)
+        now = time.time()
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+                self._modified[table] = now
+            for table in written:
+                self._written[table] = now
+
+
+table_versions = TableVersions()
+
+
+@changes.on_change
+def _bump(changed):
+    table_versions.bump({change.table for change in changed},
+                        {change.table for change in changed if change.op != "snapshot"})
+
+
+def compute_etag(tables, full_path):
+    versions = table_versions.get(tables)
+    key = f"{table_versions.boot_id}|{versions}|{full_path}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def is_not_modified(etag, last_modified, if_none_match, if_modified_since):
+    # If-None-Match wins over If-Modified-Since when both are sent
+    if if_none_match:
+        # compressed responses carry "<etag>-<encoding>", the version part is what matters
+        return if_none_match.star_tag or any(tag.partition("-")[0] == etag for tag in if_none_match)
+    if if_modified_since:
+        return int(if_modified_since.timestamp()) >= last_modified
+    return False
+
+
+def conditional(*models):
+    # answers If-None-Match / If-Modified-Since with a 304 before the view runs
+    tables = tuple(model.__tablename__ for model in models)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = compute_etag(tables, request.full_path)
+            g.conditional_tables = tables
+            # HTTP dates have one second resolution
+            last_modified = int(table_versions.last_modified(tables))
+
+            if is_not_modified(etag, last_modified, request.if_none_match, request.if_modified_since):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # let clients keep the body but revalidate it on every poll
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator